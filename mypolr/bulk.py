@@ -0,0 +1,263 @@
+"""
+This file defines the :class:`BulkRunner` class, which shortens the urls of very large input files
+with a pool of processes.
+
+The parent process first writes the unique urls of the input file to a temporary file, which is split into
+shards by byte ranges aligned to line starts. Each process has its own :class:`PolrApi` with a pooled session,
+all processes share one global rate budget, and the results are merged in the order of the input.
+"""
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+from array import array
+from collections import Counter
+
+import requests
+
+from mypolr.polr_api import PolrApi
+from mypolr.rate_limit import RateLimiter
+
+# State of each worker process, set by _init_worker
+_worker = {}
+
+# Min seconds between polls of the shared progress count, also if the progress interval is 0
+_MIN_POLL_INTERVAL = 0.1
+
+
+def shard_file(path, shards):
+    """
+    Splits a file into byte ranges of about equal size that start and end at line boundaries.
+
+    :param str path: The file to split.
+    :param int shards: The wanted number of byte ranges. Fewer are returned for small files.
+    :return: List of ``(start, end)`` byte offsets.
+    :rtype: list(tuple(int, int))
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with io.open(path, 'rb') as f:
+        for i in range(1, shards):
+            f.seek(size * i // shards)
+            f.readline()  # Move to start of next line
+            boundary = f.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def read_shard(path, start, end):
+    """
+    Yields the stripped, non-empty lines in a byte range of a file.
+
+    :param str path: The file to read.
+    :param int start: Byte offset of the first line.
+    :param int end: Byte offset where the range ends.
+    :rtype: iterator of str
+    """
+    with io.open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').strip()
+            if line:
+                yield line
+
+
+class _SharedCount:
+    """Number of requests finished by all worker processes since the last :meth:`take`, in shared memory."""
+    def __init__(self):
+        self._value = multiprocessing.Value('l', 0)
+
+    def add(self, done=1):
+        with self._value.get_lock():
+            self._value.value += done
+
+    def take(self):
+        with self._value.get_lock():
+            done = self._value.value
+            self._value.value = 0
+        return done
+
+
+def _write_unique(input_path, unique_path, canonicalizer=None):
+    """
+    Writes the first url of each unique (canonical) url of a file to another file, in order of appearance.
+
+    :return: The index in the unique file of each url in the input file.
+    :rtype: array
+    """
+    index_of = {}
+    positions = array('l')
+    with io.open(unique_path, 'w', encoding='utf-8') as f:
+        for url in read_shard(input_path, 0, os.path.getsize(input_path)):
+            key = canonicalizer(url) if canonicalizer is not None else url
+            index = index_of.get(key)
+            if index is None:
+                index = index_of[key] = len(index_of)
+                f.write(url + u'\n')
+            positions.append(index)
+    return positions
+
+
+def _init_worker(api_server, api_key, api_root, limiter, is_secret, progress=None):
+    _worker['api'] = PolrApi(api_server, api_key, api_root, session=requests.Session())
+    _worker['limiter'] = limiter
+    _worker['is_secret'] = is_secret
+    _worker['progress'] = progress
+
+
+def _run_shard(task):
+    """Shortens the urls of one shard, and writes ``short_url TAB error_code`` lines to a part file."""
+    shard_index, input_path, start, end, part_path = task
+    api = _worker['api']
+    limiter = _worker['limiter']
+    progress = _worker['progress']
+    errors = Counter()
+    with io.open(part_path, 'w', encoding='utf-8') as f:
+        for long_url in read_shard(input_path, start, end):
+            limiter.acquire()
+            result = api.shorten_result(long_url, is_secret=_worker['is_secret'])
+            if progress is not None:
+                progress.add(1)
+            if not result.ok:
+                errors[result.error_code] += 1
+            f.write(u'{}\t{}\n'.format(result.value or '', result.error_code or ''))
+    return shard_index, errors
+
+
+def _read_results(part_paths):
+    """Returns the ``(short_url, error_code)`` of each unique url from the part files, in order."""
+    results = []
+    for part_path in part_paths:
+        with io.open(part_path, 'r', encoding='utf-8') as f:
+            results.extend(tuple(line.rstrip(u'\n').split(u'\t')) for line in f)
+    return results
+
+
+class BulkRunner:
+    """
+    Shortens all urls in a file, one url per line, with a pool of processes.
+
+    The output file gets one line per input line, in the same order: ``long_url TAB short_url TAB error_code``,
+    where either ``short_url`` or ``error_code`` (the name of the :class:`MypolrError` class) is empty.
+
+    .. code-block:: python
+
+        runner = BulkRunner(api, processes=8, rate=200, canonicalizer=UrlCanonicalizer())
+        summary = runner.run('long_urls.txt', 'short_urls.tsv')
+
+    :param api: Server, key and API root are taken from this api; each process makes its own instance.
+    :type api: PolrApi
+    :param processes: Number of processes. Defaults to the number of CPUs. With 1, runs in the calling process.
+    :type processes: int or None
+    :param rate: Max requests per second for all processes together. No limit if None.
+    :type rate: float or None
+    :param canonicalizer: Used to find duplicates in the whole file, which are then shortened only once.
+                          Exact duplicates only if None.
+    :type canonicalizer: UrlCanonicalizer or None
+    :param bool is_secret: Make secret short urls.
+    :param shards_per_process: Number of shards per process. More shards balance the load better.
+    :type shards_per_process: int
+    :param progress: Records each input line; its total is set to the number of lines if None. Duplicates and
+                     their errors are recorded when all urls are shortened, and errors are counted per line.
+                     Worker processes count requests in shared memory, which is polled every
+                     ``progress.interval`` seconds.
+    :type progress: ProgressReporter or None
+    """
+    def __init__(self, api, processes=None, rate=None, canonicalizer=None, is_secret=False, shards_per_process=4,
+                 progress=None):
+        self.api = api
+        self.processes = processes or multiprocessing.cpu_count()
+        self.rate = rate
+        self.canonicalizer = canonicalizer
+        self.is_secret = is_secret
+        self.shards_per_process = shards_per_process
+        self.progress = progress
+
+    def _worker_args(self, shared, progress):
+        return (self.api.api_server, self.api.api_key, self.api.api_root,
+                RateLimiter(self.rate, shared=shared), self.is_secret, progress)
+
+    def _shard_results(self, pool, tasks, counter):
+        """Yields the results of the shards as they finish, and moves the shared count to the progress meanwhile."""
+        shard_results = pool.imap_unordered(_run_shard, tasks)
+        if counter is None:
+            for shard_result in shard_results:
+                yield shard_result
+            return
+        timeout = max(self.progress.interval, _MIN_POLL_INTERVAL)
+        while True:
+            try:
+                shard_result = shard_results.next(timeout=timeout)
+            except StopIteration:
+                return
+            except multiprocessing.TimeoutError:
+                self.progress.add(counter.take())
+                continue
+            # Requests of the shard must be counted before its errors
+            self.progress.add(counter.take())
+            yield shard_result
+
+    def run(self, input_path, output_path):
+        """
+        Shortens the urls in ``input_path`` and writes the results to ``output_path``.
+
+        :param str input_path: File with one long url per line.
+        :param str output_path: File to write results to.
+        :return: Summary with the number of ``urls`` and ``errors``.
+        :rtype: dict
+        """
+        part_dir = tempfile.mkdtemp(prefix='mypolr-', dir=os.path.dirname(os.path.abspath(output_path)))
+        summary = dict(urls=0, errors=0)
+        progress = self.progress
+        pool = None
+        try:
+            unique_path = os.path.join(part_dir, 'unique')
+            positions = _write_unique(input_path, unique_path, self.canonicalizer)
+            shards = shard_file(unique_path, self.processes * self.shards_per_process)
+            tasks = [(i, unique_path, start, end, os.path.join(part_dir, 'part{}'.format(i)))
+                     for i, (start, end) in enumerate(shards)]
+            if progress is not None:
+                progress.concurrency = self.processes
+                if progress.total is None:
+                    progress.total = len(positions)
+            if self.processes == 1:
+                _init_worker(*self._worker_args(shared=False, progress=progress))
+                shard_results = map(_run_shard, tasks)
+            else:
+                counter = _SharedCount() if progress is not None else None
+                pool = multiprocessing.Pool(self.processes, _init_worker,
+                                            self._worker_args(shared=True, progress=counter))
+                shard_results = self._shard_results(pool, tasks, counter)
+            for _, errors in shard_results:
+                if progress is not None:
+                    progress.add(0, errors)
+            if pool is not None:
+                pool.close()
+                pool.join()
+            results = _read_results([task[-1] for task in tasks])
+            duplicate_errors = Counter()
+            next_unique = 0
+            with io.open(output_path, 'w', encoding='utf-8') as output:
+                for long_url, index in zip(read_shard(input_path, 0, os.path.getsize(input_path)), positions):
+                    short_url, error_code = results[index]
+                    if index == next_unique:  # First line of a unique url
+                        next_unique += 1
+                    elif error_code:
+                        duplicate_errors[error_code] += 1
+                    if error_code:
+                        summary['errors'] += 1
+                    output.write(u'{}\t{}\t{}\n'.format(long_url, short_url, error_code))
+            summary['urls'] = len(positions)
+            if progress is not None:
+                progress.add(len(positions) - len(results), duplicate_errors)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            shutil.rmtree(part_dir, ignore_errors=True)
+        return summary
@@ -0,0 +1,140 @@
+"""
+This file defines the :class:`LookupCache` used by :class:`PolrApi` to cache lookup results,
+and the :class:`Prefetcher` which warms the cache in the background.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from mypolr.rate_limit import RateLimiter
+
+_MISSING = object()
+
+
+def parse_ending(line):
+    """
+    Returns the url ending and url key from a line of input. Secret urls are given as ``ending/url_key``.
+
+    :param str line: An url ending, optionally followed by ``/`` and the url key.
+    :rtype: tuple(str, str or None)
+    """
+    ending, _, url_key = line.strip().partition('/')
+    return ending, url_key or None
+
+
+class LookupCache:
+    """
+    Thread-safe cache of lookup results with a time to live, evicting the least recently used entries when full.
+
+    Results of lookups that found no url (``False``) are cached as well.
+
+    :param float ttl: Seconds before an entry expires.
+    :param int maxsize: Max number of entries.
+    :param clock: Function returning the current time in seconds.
+    :type clock: callable
+    """
+    def __init__(self, ttl=300.0, maxsize=10000, clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the cached value of ``key``, or ``default`` if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return default
+            # Mark as recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        """Caches ``value`` for ``key`` for the next :attr:`ttl` seconds."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def expires(self, key):
+        """Returns the time when ``key`` expires, or None if not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._entries.clear()
+
+
+class Prefetcher:
+    """
+    Background thread that warms the lookup cache of an api, and refreshes entries before they expire.
+
+    Made and started by :meth:`PolrApi.prefetch`.
+
+    :param api: The api with the cache to warm.
+    :type api: PolrApi
+    :param endings: Url endings to prefetch, with ``/url_key`` appended for secret urls. Empty lines are skipped.
+    :type endings: iterable of str
+    :param rate: Max lookups per second. No limit if None.
+    :type rate: float or None
+    :param refresh_ahead: Seconds before expiry when an entry is refreshed. Defaults to 20 % of the cache's ttl.
+    :type refresh_ahead: float or None
+    :param float check_interval: Seconds between checks for entries to refresh.
+    """
+    def __init__(self, api, endings, rate=10.0, refresh_ahead=None, check_interval=1.0):
+        self.api = api
+        self.keys = [parse_ending(line) for line in endings if line.strip()]
+        self.limiter = RateLimiter(rate)
+        cache = api.lookup_cache
+        self.refresh_ahead = cache.ttl * 0.2 if refresh_ahead is None else refresh_ahead
+        self.check_interval = check_interval
+        #: Set when all endings have been looked up once.
+        self.warmed = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mypolr-prefetch')
+        self._thread.daemon = True
+
+    def start(self):
+        """Starts the background thread and returns the prefetcher."""
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the background thread."""
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _fetch(self, key):
+        self.limiter.acquire()
+        self.api._lookup(key[0], key[1], cached=False)
+
+    def refresh(self):
+        """Looks up all endings that are not cached or expire within :attr:`refresh_ahead` seconds."""
+        cache = self.api.lookup_cache
+        for key in self.keys:
+            if self._stopping.is_set():
+                return
+            expires = cache.expires(key)
+            if expires is None or expires - cache.clock() <= self.refresh_ahead:
+                self._fetch(key)
+
+    def _run(self):
+        for key in self.keys:
+            if self._stopping.is_set():
+                return
+            self._fetch(key)
+        self.warmed.set()
+        while not self._stopping.wait(self.check_interval):
+            self.refresh()
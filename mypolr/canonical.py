@@ -0,0 +1,119 @@
+"""
+This file defines :class:`UrlCanonicalizer` and :func:`deduplicate`, which are used to avoid shortening the same
+destination more than once in bulk jobs.
+
+Variants of the same url, e.g. with other query parameter order, tracking parameters, host casing or a trailing slash,
+are rewritten to one canonical form, and only the first url of each canonical form is sent to the API.
+"""
+try:
+    from urllib.parse import urlsplit, urlunsplit, unquote_plus
+except ImportError:  # Python 2
+    from urlparse import urlsplit, urlunsplit
+    from urllib import unquote_plus
+
+#: Query parameters removed by default. Names ending with ``*`` are matched as prefixes.
+DEFAULT_TRACKING_PARAMS = ('utm_*', 'fbclid', 'gclid')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class UrlCanonicalizer:
+    """
+    Rewrites urls to a canonical form according to configurable rules.
+
+    Calling the instance with an url returns the canonical url. Urls that cannot be parsed are returned unchanged.
+    Query parameters are never re-encoded; they are only filtered and reordered.
+    Sorting is stable and by name only, so repeated parameters such as ``tag=b&tag=a`` keep their order.
+
+    :param strip_params: Names of query parameters to remove. Names ending with ``*`` are matched as prefixes.
+    :type strip_params: tuple(str) or list(str)
+    :param bool sort_query: Sort query parameters by name.
+    :param bool lowercase_host: Make scheme and host lowercase.
+    :param bool drop_default_port: Remove ``:80`` from http-urls and ``:443`` from https-urls.
+    :param bool drop_fragment: Remove the ``#fragment``.
+    :param bool strip_trailing_slash: Remove trailing slash from the path, except for the root path ``/``.
+    """
+    def __init__(self, strip_params=DEFAULT_TRACKING_PARAMS, sort_query=True, lowercase_host=True,
+                 drop_default_port=True, drop_fragment=True, strip_trailing_slash=True):
+        self.strip_exact = frozenset(name for name in strip_params if not name.endswith('*'))
+        self.strip_prefixes = tuple(name[:-1] for name in strip_params if name.endswith('*'))
+        self.sort_query = sort_query
+        self.lowercase_host = lowercase_host
+        self.drop_default_port = drop_default_port
+        self.drop_fragment = drop_fragment
+        self.strip_trailing_slash = strip_trailing_slash
+
+    def _keep_param(self, pair):
+        name = unquote_plus(pair.split('=', 1)[0])
+        return name not in self.strip_exact and not name.startswith(self.strip_prefixes)
+
+    def _netloc(self, parts):
+        netloc = parts.netloc
+        if not (self.lowercase_host or self.drop_default_port):
+            return netloc
+        userinfo, _, hostport = netloc.rpartition('@')
+        port = parts.port
+        host = parts.hostname if self.lowercase_host else hostport.rsplit(':', 1)[0] if port else hostport
+        if host is None:
+            return netloc
+        if ':' in host and not host.startswith('['):
+            host = '[{}]'.format(host)  # IPv6
+        if port is not None and not (self.drop_default_port and DEFAULT_PORTS.get(parts.scheme.lower()) == port):
+            host = '{}:{}'.format(host, port)
+        return '{}@{}'.format(userinfo, host) if userinfo else host
+
+    def __call__(self, url):
+        try:
+            parts = urlsplit(url.strip())
+            netloc = self._netloc(parts)
+        except ValueError:
+            return url
+        scheme = parts.scheme.lower() if self.lowercase_host else parts.scheme
+        path = parts.path or '/'
+        if self.strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        query = parts.query
+        if query:
+            pairs = [pair for pair in query.split('&') if pair and self._keep_param(pair)]
+            if self.sort_query:
+                pairs.sort(key=lambda pair: unquote_plus(pair.split('=', 1)[0]))
+            query = '&'.join(pairs)
+        fragment = '' if self.drop_fragment else parts.fragment
+        return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def deduplicate(urls, canonicalizer=None):
+    """
+    Finds the unique urls in a sequence, optionally comparing their canonical forms.
+
+    The canonical form is only used to find duplicates; the url returned for each group is the first given url,
+    so that no rewritten url is ever shortened.
+
+    Example:
+
+    .. code-block:: python
+
+        unique, positions = deduplicate(urls, UrlCanonicalizer())
+        results = [api.shorten(url) for url in unique]
+        # Fan results back to the original order, including duplicates:
+        results = [results[i] for i in positions]
+
+    :param urls: The urls to deduplicate.
+    :type urls: iterable of str
+    :param canonicalizer: Function that maps an url to its canonical form. Exact duplicates only if None.
+    :type canonicalizer: UrlCanonicalizer or callable or None
+    :return: A list of the first url of each unique (canonical) url, in order of appearance,
+             and a list with the index in that list for each of the given urls.
+    :rtype: list(str), list(int)
+    """
+    unique = []
+    index_of = {}
+    positions = []
+    for url in urls:
+        key = canonicalizer(url) if canonicalizer is not None else url
+        index = index_of.get(key)
+        if index is None:
+            index = index_of[key] = len(unique)
+            unique.append(url)
+        positions.append(index)
+    return unique, positions
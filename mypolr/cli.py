@@ -11,8 +11,133 @@ from pathlib import Path
 from configparser import ConfigParser
 import argparse
 import stat
+import sys
 
-from mypolr import __version__, exceptions, PolrApi, DEFAULT_API_ROOT
+import requests
+from requests.adapters import HTTPAdapter
+
+from mypolr import __version__, config, exceptions, PolrApi, DEFAULT_API_ROOT
+from mypolr.loadtest import LoadTest, StubPolrServer, format_report
+from mypolr.migrate import export_links, migrate_links
+from mypolr.progress import ProgressReporter
+
+
+def add_api_arguments(parser, description='Use these for configure the API. Can be stored locally with --save.'):
+    """Adds the arguments for server, key and API root to a parser."""
+    api_group = parser.add_argument_group('API server arguments', description)
+
+    api_group.add_argument("-s", "--server", default=None, help="Server hosting the API.")
+    api_group.add_argument("-k", "--key", default=None, help="API_KEY to authenticate against server.")
+    api_group.add_argument("--api-root", default=DEFAULT_API_ROOT,
+                           help="API endpoint root.")
+    api_group.add_argument("-p", "--profile", default=None,
+                           help="Named profile (section) in the config file to use or save. "
+                                "Defaults to MYPOLR_PROFILE, or '{}'.".format(config.DEFAULT_PROFILE))
+
+
+def make_pooled_session(pool_maxsize):
+    """
+    Returns a session that keeps up to ``pool_maxsize`` connections per host alive, one per concurrent request.
+
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def add_bulk_arguments(parser):
+    """Adds the arguments for input, output and throughput of the bulk subcommands to a parser."""
+    parser.add_argument("endings", nargs='?', default='-',
+                        help="File with one url ending per line, with '/URL_KEY' appended for secret urls. "
+                             "Reads from stdin if '-'.")
+    parser.add_argument("-o", "--output", default=None, help="File to write results to. Defaults to stdout.")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of concurrent requests.")
+    parser.add_argument("-r", "--rate", type=float, default=None, help="Max requests per second.")
+    parser.add_argument("--progress-interval", type=float, default=1.0,
+                        help="Seconds between progress reports to stderr. No reports if 0.")
+
+
+def make_export_argparser():
+    """
+    Setup argparse arguments for the ``export`` subcommand.
+
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog='mypolr export',
+                                     description="Looks up a list of url endings and writes "
+                                                 "'ENDING TAB LONG_URL' lines.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_bulk_arguments(parser)
+    add_api_arguments(parser, 'The server to export from. Saved values are used if not given.')
+    parser.set_defaults(command='export')
+    return parser
+
+
+def make_migrate_argparser():
+    """
+    Setup argparse arguments for the ``migrate`` subcommand.
+
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog='mypolr migrate',
+                                     description="Recreates short urls from one server on another server, "
+                                                 "with the same custom endings.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_bulk_arguments(parser)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only look up the urls on the source server.")
+    add_api_arguments(parser, 'The server to migrate from. Saved values are used if not given.')
+    target_group = parser.add_argument_group('Target server arguments', 'The server to migrate to.')
+    target_group.add_argument("--target-server", required=True, help="Server hosting the target API.")
+    target_group.add_argument("--target-key", required=True, help="API_KEY to authenticate against target server.")
+    target_group.add_argument("--target-api-root", default=DEFAULT_API_ROOT, help="Target API endpoint root.")
+    parser.set_defaults(command='migrate')
+    return parser
+
+
+def make_loadtest_argparser():
+    """
+    Setup argparse arguments for the ``loadtest`` subcommand.
+
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog='mypolr loadtest',
+                                     description="Sends a mix of shortens and lookups to a server, and reports "
+                                                 "throughput, latency percentiles and errors.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("corpus", nargs='?', default=None,
+                        help="File with one long url per line to shorten, or '-' for stdin. "
+                             "Synthetic urls are used if not given.")
+    parser.add_argument("-n", "--requests", type=int, default=1000,
+                        help="Number of requests to send. No limit if 0, but then --duration must be given.")
+    parser.add_argument("-d", "--duration", type=float, default=None, help="Max seconds to run.")
+    parser.add_argument("--lookup-ratio", type=float, default=0.5,
+                        help="Share of requests that are lookups of the urls shortened so far, from 0 to 1.")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Number of concurrent requests.")
+    parser.add_argument("-r", "--rate", type=float, default=None, help="Max requests per second.")
+    parser.add_argument("--progress-interval", type=float, default=1.0,
+                        help="Seconds between progress reports to stderr. No reports if 0.")
+    stub_group = parser.add_argument_group('Stub server arguments',
+                                           'Run against a local stand-in for a Polr server instead.')
+    stub_group.add_argument("--stub", action="store_true",
+                            help="Start a local stub server and test it. Server and key are not used.")
+    stub_group.add_argument("--stub-latency", type=float, default=0.0,
+                            help="Seconds the stub server waits before each response.")
+    stub_group.add_argument("--stub-error-rate", type=float, default=0.0,
+                            help="Share of requests the stub server answers with an error, from 0 to 1.")
+    add_api_arguments(parser, 'The server to test. Saved values are used if not given.')
+    parser.set_defaults(command='loadtest')
+    return parser
+
+
+SUBCOMMANDS = {
+    'export': make_export_argparser,
+    'migrate': make_migrate_argparser,
+    'loadtest': make_loadtest_argparser,
+}
 
 
 def make_argparser():
@@ -32,13 +157,7 @@ def make_argparser():
 
     parser.add_argument("url", nargs='?', default=None, help="The url to process.")
 
-    api_group = parser.add_argument_group('API server arguments',
-                                          'Use these for configure the API. Can be stored locally with --save.')
-
-    api_group.add_argument("-s", "--server", default=None, help="Server hosting the API.")
-    api_group.add_argument("-k", "--key", default=None, help="API_KEY to authenticate against server.")
-    api_group.add_argument("--api-root", default=DEFAULT_API_ROOT,
-                           help="API endpoint root.")
+    add_api_arguments(parser)
 
     option_group = parser.add_argument_group('Action options',
                                              'Configure the API action to use.')
@@ -58,11 +177,19 @@ def make_argparser():
                               help="Save configuration (including credentials) in plaintext(!).")
     manage_group.add_argument("--clear", action="store_true",
                               help="Clear configuration.")
+    parser.set_defaults(command=None)
     return parser
 
 
 def get_args(arguments=None):
     """This method makes it possible to test the parser independently"""
+    arguments = sys.argv[1:] if arguments is None else arguments
+    if arguments and arguments[0] in SUBCOMMANDS:
+        args = SUBCOMMANDS[arguments[0]]().parse_args(arguments[1:])
+        # Options of the main parser that are not used by subcommands
+        args.url = args.custom = None
+        args.version = args.save = args.clear = args.lookup = args.secret = False
+        return args
     return make_argparser().parse_args(arguments)
 
 
@@ -78,12 +205,12 @@ class MypolrCli:
     def __init__(self, output_stream=None, args_override=None):
         # Output stream, defaults to sys.stdout
         self.print_io = output_stream
+        # Parse args. Use args_override when testing MypolrCli
+        self.args = args = get_args(args_override)
         # define config.ini
-        self.ini_header = 'connection'
+        self.ini_header = config.selected_profile(args.profile)
         self.config_folder = Path().home() / '.mypolr'
         self.config_file = self.config_folder / 'config.ini'
-        # Parse args. Use args_override when testing MypolrCli
-        self.args = args = get_args(args_override)
         # Common vars
         self.api_server = args.server
         self.api_root = args.api_root
@@ -99,18 +226,28 @@ class MypolrCli:
             self.save_ini()
         if self.args.clear:
             self.clear_ini()
-        if self.config_file.exists():
-            self.load_configs_from_ini()
-        self.call_api()
+        self.load_configs_from_ini()
+        if self.args.command is not None:
+            self.call_subcommand()
+        else:
+            self.call_api()
 
     def make_ini_getter(self):
-        config = ConfigParser()
-        config.read(str(self.config_file))
+        parser = config.read_config_file(str(self.config_file))
 
         def get_ini_value(field, fallback=None):
-            return config.get(self.ini_header, field, fallback=fallback)
+            return parser.get(self.ini_header, field) if parser.has_option(self.ini_header, field) else fallback
         return get_ini_value
 
+    def write_ini_section(self, values):
+        # Read the file again to keep other profiles unchanged
+        parser = ConfigParser()
+        parser.read(str(self.config_file))
+        parser[self.ini_header] = values
+        with self.config_file.open('w') as f:
+            parser.write(f)
+        config.forget_config_file(str(self.config_file))
+
     def save_ini(self):
         if any(value is None for value in [self.api_server, self.api_key]):
             print('\nDid not save: Provide at least both SERVER and KEY.\n', file=self.print_io)
@@ -118,27 +255,23 @@ class MypolrCli:
             # Save api connection values to config file
             self.config_folder.mkdir(exist_ok=True)
             self.config_file.touch(stat.S_IRWXU)
-            config = ConfigParser()
-            config[self.ini_header] = dict(api_server=self.api_server, api_key=self.api_key, api_root=self.api_root)
-            with self.config_file.open('w') as f:
-                config.write(f)
-                print('Config file saved: {}'.format(self.config_file), file=self.print_io)
+            self.write_ini_section(dict(api_server=self.api_server, api_key=self.api_key, api_root=self.api_root))
+            print('Config file saved: {}'.format(self.config_file), file=self.print_io)
 
     def clear_ini(self):
         if self.config_file.exists():
-            config = ConfigParser()
-            config[self.ini_header] = dict()
-            with self.config_file.open('w') as f:
-                config.write(f)
-                print('Config file cleared: {}'.format(self.config_file), file=self.print_io)
+            self.write_ini_section(dict())
+            print('Config file cleared: {}'.format(self.config_file), file=self.print_io)
         else:
             print('\nDid not clear: configuration file does not exists.', file=self.print_io)
 
     def load_configs_from_ini(self):
-        ini_value = self.make_ini_getter()
-        self.api_server = self.api_server or ini_value('api_server')
-        self.api_root = self.api_root or ini_value('api_root')
-        self.api_key = self.api_key or ini_value('api_key')
+        """Fills in values not given as arguments from environment variables or the config file."""
+        values = config.load_config(self.ini_header, str(self.config_file))
+        self.api_server = self.api_server or values['api_server']
+        self.api_key = self.api_key or values['api_key']
+        if self.api_root == DEFAULT_API_ROOT and values['api_root']:
+            self.api_root = values['api_root']
 
     def call_api_action(self):
         print('Processing {}\n'.format(self.url), file=self.print_io)
@@ -166,3 +299,105 @@ class MypolrCli:
                 print('Incomplete arguments for API action. Missing: {}'.format(missing_args), file=self.print_io)
         else:
             self.call_api_action()
+
+    def run_export(self, api, endings, output, progress):
+        links = errors = 0
+        for ending, result in export_links(api, endings, self.args.workers, self.args.rate, progress):
+            links += 1
+            if result.value:
+                print('{}\t{}'.format(ending, result.value.get('long_url')), file=output)
+            else:
+                errors += 1
+                print('{}: {}'.format(ending, result.error_code or 'not found'), file=sys.stderr)
+        return links, errors
+
+    def run_migrate(self, api, endings, output, progress):
+        session = make_pooled_session(self.args.workers)
+        target = PolrApi(self.args.target_server, self.args.target_key, self.args.target_api_root, session=session)
+        links = errors = 0
+        try:
+            for ending, lookup, shortened in migrate_links(api, target, endings, self.args.workers, self.args.rate,
+                                                           dry_run=self.args.dry_run, progress=progress):
+                links += 1
+                if not lookup.value:
+                    errors += 1
+                    print('{}: {} on source'.format(ending, lookup.error_code or 'not found'), file=sys.stderr)
+                elif shortened is None:
+                    print('{}\t{}\t(dry run)'.format(ending, lookup.value.get('long_url')), file=output)
+                elif shortened.ok:
+                    print('{}\t{}\t{}'.format(ending, lookup.value.get('long_url'), shortened.value), file=output)
+                else:
+                    errors += 1
+                    print('{}: {} on target'.format(ending, shortened.error_code), file=sys.stderr)
+        finally:
+            session.close()
+        return links, errors
+
+    def make_progress(self, endings):
+        """Returns a progress reporter writing to stderr, or None if disabled by ``--progress-interval 0``."""
+        if not self.args.progress_interval:
+            return None
+        total = len(endings) if isinstance(endings, list) else None
+        return ProgressReporter(total=total, interval=self.args.progress_interval)
+
+    def run_loadtest(self):
+        args = self.args
+        if not args.requests and args.duration is None:
+            print('Either REQUESTS or DURATION must be given for loadtest', file=self.print_io)
+            return
+        stub = None
+        if args.stub:
+            stub = StubPolrServer(latency=args.stub_latency, error_rate=args.stub_error_rate).start()
+            api_server, api_key, api_root = stub.url, stub.api_key, DEFAULT_API_ROOT
+        elif self.api_server is None or self.api_key is None:
+            print('Incomplete arguments for loadtest. Missing: SERVER and/or KEY, or --stub', file=self.print_io)
+            return
+        else:
+            api_server, api_key, api_root = self.api_server, self.api_key, self.api_root
+        corpus = None
+        if args.corpus is not None:
+            f = sys.stdin if args.corpus == '-' else open(args.corpus)
+            with f:
+                corpus = [line.strip() for line in f if line.strip()]
+        session = make_pooled_session(args.concurrency)
+        api = PolrApi(api_server, api_key, api_root, session=session)
+        progress = ProgressReporter(interval=args.progress_interval) if args.progress_interval else None
+        try:
+            report = LoadTest(api, corpus, args.lookup_ratio, args.rate, args.concurrency, progress).run(
+                args.requests or None, args.duration)
+            if progress is not None:
+                progress.close()
+        finally:
+            session.close()
+            if stub is not None:
+                stub.stop()
+        print(format_report(report), file=self.print_io)
+
+    def call_subcommand(self):
+        if self.args.command == 'loadtest':
+            self.run_loadtest()
+            return
+        if self.api_server is None or self.api_key is None:
+            print('Incomplete arguments for {}. Missing: SERVER and/or KEY'.format(self.args.command),
+                  file=self.print_io)
+            return
+        if self.args.endings == '-':
+            endings = sys.stdin
+        else:
+            # Read files up front, to know the total for the progress reports
+            with open(self.args.endings) as f:
+                endings = [line for line in f if line.strip()]
+        progress = self.make_progress(endings)
+        output = open(self.args.output, 'w') if self.args.output else self.print_io
+        session = make_pooled_session(self.args.workers)
+        api = PolrApi(self.api_server, self.api_key, self.api_root, session=session)
+        try:
+            run = self.run_export if self.args.command == 'export' else self.run_migrate
+            links, errors = run(api, endings, output, progress)
+            if progress is not None:
+                progress.close()
+            print('Done: {} links, {} errors'.format(links, errors), file=sys.stderr)
+        finally:
+            session.close()
+            if self.args.output:
+                output.close()
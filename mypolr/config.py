@@ -0,0 +1,88 @@
+"""
+This file handles configuration of server, key and API root from environment variables
+and from the configuration file, ``~/.mypolr/config.ini``.
+
+The file can hold several named profiles, one section each. The default profile is the ``[connection]``-section,
+which is the one saved by the CLI when no profile is given. The file is parsed at most once per process,
+and is not read at all when both server and key are given by environment variables.
+"""
+import os
+import threading
+
+try:
+    from configparser import ConfigParser
+except ImportError:  # Python 2
+    from ConfigParser import ConfigParser
+
+DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser('~'), '.mypolr', 'config.ini')
+DEFAULT_PROFILE = 'connection'
+
+#: Environment variables that override the values of the configuration file.
+ENV_VARS = {
+    'api_server': 'MYPOLR_SERVER',
+    'api_key': 'MYPOLR_KEY',
+    'api_root': 'MYPOLR_API_ROOT',
+}
+#: Environment variable with the name of the profile to use, if not given otherwise.
+ENV_PROFILE = 'MYPOLR_PROFILE'
+
+_parsed_files = {}
+_lock = threading.Lock()
+
+
+def read_config_file(path=None):
+    """
+    Returns the parsed configuration file. Each file is only read and parsed the first time.
+
+    A missing file gives an empty configuration.
+
+    :param path: Path of the file. Defaults to ``~/.mypolr/config.ini``.
+    :type path: str or None
+    :rtype: ConfigParser
+    """
+    path = path or DEFAULT_CONFIG_FILE
+    with _lock:
+        config = _parsed_files.get(path)
+        if config is None:
+            config = _parsed_files[path] = ConfigParser()
+            config.read(path)
+    return config
+
+
+def forget_config_file(path=None):
+    """Makes the next :func:`read_config_file` read the file again, e.g. after it has been changed."""
+    with _lock:
+        _parsed_files.pop(path or DEFAULT_CONFIG_FILE, None)
+
+
+def selected_profile(profile=None, environ=None):
+    """Returns the given profile, or the one in the ``MYPOLR_PROFILE`` environment variable, or the default."""
+    environ = os.environ if environ is None else environ
+    return profile or environ.get(ENV_PROFILE) or DEFAULT_PROFILE
+
+
+def load_config(profile=None, path=None, environ=None):
+    """
+    Returns the values of a profile, or of the environment variables in :data:`ENV_VARS`.
+
+    Server and key are taken from the environment only if both are set there, so that the key of a profile is
+    never sent to another server. ``MYPOLR_API_ROOT`` overrides the API root of either.
+
+    :param profile: Name of the profile (section) in the configuration file. See :func:`selected_profile`.
+    :type profile: str or None
+    :param path: Path of the configuration file. Defaults to ``~/.mypolr/config.ini``.
+    :type path: str or None
+    :param environ: Environment variables. Defaults to ``os.environ``.
+    :type environ: dict or None
+    :return: Dictionary with ``api_server``, ``api_key`` and ``api_root``. Values not found are None.
+    :rtype: dict
+    """
+    environ = os.environ if environ is None else environ
+    values = dict((field, environ.get(name)) for field, name in ENV_VARS.items())
+    if values['api_server'] is None or values['api_key'] is None:
+        config = read_config_file(path)
+        profile = selected_profile(profile, environ)
+        for field, value in values.items():
+            if field != 'api_root' or value is None:
+                values[field] = config.get(profile, field) if config.has_option(profile, field) else None
+    return values
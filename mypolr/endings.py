@@ -0,0 +1,166 @@
+"""
+This file defines the :class:`EndingAllocator` class, which creates short urls with custom endings
+generated from a pattern.
+
+The Polr API only tells that a custom ending is taken by refusing it. The allocator keeps a local set of
+endings known to be in use, seeded from lookups, a :class:`ReverseIndex` and earlier shortenings,
+so that known collisions are skipped without a request.
+"""
+import itertools
+import random
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mypolr import exceptions
+from mypolr.results import ApiResult
+
+try:
+    _string_types = basestring
+except NameError:  # Python 3
+    _string_types = str
+
+#: Characters used for ``{rand}`` in patterns.
+ENDING_ALPHABET = string.ascii_letters + string.digits
+
+# Stop looking for an unused candidate after this many known collisions in a row
+_MAX_SKIPPED_CANDIDATES = 100000
+
+
+def pattern_candidates(pattern, start=1, rand_length=4):
+    """
+    Yields custom endings made from a pattern.
+
+    The pattern is formatted with ``n``, a counter, and ``rand``, random letters and digits.
+    E.g. ``'sale-{n}'`` yields ``'sale-1'``, ``'sale-2'``, ..., and ``'sale-{rand}'`` yields e.g. ``'sale-x7Gq'``.
+
+    :param str pattern: Format string with ``{n}`` and/or ``{rand}``.
+    :param int start: First value of ``n``.
+    :param int rand_length: Length of ``rand``.
+    :rtype: iterator of str
+    """
+    n = start
+    while True:
+        rand = ''.join(random.choice(ENDING_ALPHABET) for _ in range(rand_length))
+        yield pattern.format(n=n, rand=rand)
+        n += 1
+
+
+class EndingAllocator:
+    """
+    Creates short urls with the first available custom ending from a sequence of candidates.
+
+    Candidates known to be in use are skipped locally. Each url tries its candidates one at a time,
+    since every accepted ending creates a short url; :meth:`allocate_many` instead shortens many urls
+    concurrently, drawing from one shared sequence of candidates.
+
+    .. code-block:: python
+
+        allocator = EndingAllocator(api, used_endings=['sale-1', 'sale-2'])
+        allocator.seed_from_index(reverse_index)
+        short_url = allocator.allocate(long_url, 'sale-{n}')    # Tries 'sale-3', 'sale-4', ...
+
+    :param api: The api used to shorten urls.
+    :type api: PolrApi
+    :param used_endings: Endings known to be in use.
+    :type used_endings: iterable of str
+    :param int max_attempts: Number of requests per url before giving up.
+    :param int workers: Number of threads used by :meth:`allocate_many`.
+    """
+    def __init__(self, api, used_endings=(), max_attempts=20, workers=4):
+        self.api = api
+        self.used = set(used_endings)
+        self.max_attempts = max_attempts
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    def __contains__(self, ending):
+        return ending in self.used
+
+    def mark_used(self, ending):
+        """Records that a custom ending is in use."""
+        with self._lock:
+            self.used.add(ending)
+
+    def seed_from_lookup(self, lookup_url, lookup_result):
+        """
+        Records the ending of a short url as used if the result of :meth:`PolrApi.lookup` shows that it exists.
+
+        :param str lookup_url: An url ending or full short url address
+        :param lookup_result: The result of the lookup.
+        :type lookup_result: dict or bool or None
+        """
+        if lookup_result:
+            self.mark_used(self._ending(lookup_url))
+
+    def seed_from_index(self, reverse_index):
+        """
+        Records the endings of all short urls in a :class:`ReverseIndex` as used.
+
+        :type reverse_index: ReverseIndex
+        """
+        endings = [self._ending(short_url) for short_url in reverse_index.short_urls()]
+        with self._lock:
+            self.used.update(endings)
+
+    def _ending(self, short_url):
+        # Drop the url key of secret urls
+        return self.api._get_ending(short_url).split('/', 1)[0]
+
+    def _reserve(self, candidates):
+        """Returns the next candidate not known to be used, and marks it as used. None if there are no more."""
+        with self._lock:
+            for ending in itertools.islice(candidates, _MAX_SKIPPED_CANDIDATES):
+                if ending not in self.used:
+                    self.used.add(ending)
+                    return ending
+        return None
+
+    def _allocate(self, long_url, candidates, is_secret):
+        ending = None
+        for _ in range(self.max_attempts):
+            ending = self._reserve(candidates)
+            if ending is None:
+                break
+            result = self.api.shorten_result(long_url, custom_ending=ending, is_secret=is_secret)
+            if result.error is not exceptions.CustomEndingUnavailable:
+                if not result.ok:
+                    # The ending was not taken, so it can be tried again later
+                    with self._lock:
+                        self.used.discard(ending)
+                return result
+        return ApiResult(error=(exceptions.CustomEndingUnavailable, (ending,)))
+
+    @staticmethod
+    def _candidates(candidates):
+        return pattern_candidates(candidates) if isinstance(candidates, _string_types) else iter(candidates)
+
+    def allocate(self, long_url, candidates, is_secret=False):
+        """
+        Shortens an url with the first available ending among the candidates.
+
+        :param str long_url: The url to shorten.
+        :param candidates: A pattern for :func:`pattern_candidates`, or the custom endings to try in order.
+        :type candidates: str or iterable of str
+        :param bool is_secret: if not public, it's secret
+        :return: a short link
+        :rtype: str
+        :raises CustomEndingUnavailable: if no candidate was available within ``max_attempts``.
+        """
+        return self._allocate(long_url, self._candidates(candidates), is_secret).raise_for_error()
+
+    def allocate_many(self, long_urls, candidates, is_secret=False):
+        """
+        Shortens many urls concurrently, each with the next available ending among the shared candidates.
+
+        :param long_urls: The urls to shorten.
+        :type long_urls: iterable of str
+        :param candidates: A pattern for :func:`pattern_candidates`, or the custom endings to try in order.
+        :type candidates: str or iterable of str
+        :param bool is_secret: if not public, it's secret
+        :return: Result for each url, in the same order.
+        :rtype: list(ApiResult)
+        """
+        candidates = self._candidates(candidates)
+        with ThreadPoolExecutor(self.workers) as executor:
+            return list(executor.map(lambda long_url: self._allocate(long_url, candidates, is_secret), long_urls))
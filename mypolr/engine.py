@@ -0,0 +1,134 @@
+"""
+This file defines the :class:`ApiEngine` class, which runs the calls of one :class:`PolrApi` on a shared pool
+of threads, so that sync code and asyncio code in the same process can use one pooled, cached and
+rate-limited client.
+
+Sync callers get blocking results or ``concurrent.futures.Future`` objects, and asyncio callers get awaitables
+that do not block their event loop.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from mypolr.cache import LookupCache
+from mypolr.rate_limit import RateLimiter
+from mypolr.results import ApiResult
+
+
+class ApiEngine:
+    """
+    Runs shortens and lookups of an api on a pool of threads, with an optional rate limit for all callers.
+
+    Made by :meth:`PolrApi.make_engine`. The engine uses the session and lookup cache of the api if it has them.
+    Otherwise it uses a copy of the api with a session of its own (one pooled connection per thread) and/or
+    a cache of its own, so the given api is never changed. The reverse index is shared with the api.
+    Lookups that are cached are answered at once, without waiting for the rate limit or a thread.
+
+    .. code-block:: python
+
+        engine = api.make_engine(workers=16, rate=50)
+
+        short_url = engine.shorten(long_url)            # Sync code, e.g. a Django view
+        future = engine.submit_lookup('5N3f8')          # concurrent.futures.Future of an ApiResult
+        result = await engine.lookup_async('5N3f8')     # Coroutine on an asyncio event loop
+
+    :param api: The api to make calls with.
+    :type api: PolrApi
+    :param int workers: Max number of concurrent requests.
+    :param rate: Max requests per second. No limit if None.
+    :type rate: float or None
+    :param lookup_cache: Cache of lookup results. Defaults to the cache of the api, or a new :class:`LookupCache`.
+    :type lookup_cache: LookupCache or None
+    """
+    def __init__(self, api, workers=10, rate=None, lookup_cache=None):
+        self._session = None
+        session = api.session
+        if session is None:
+            session = self._session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        if lookup_cache is None:
+            lookup_cache = api.lookup_cache if api.lookup_cache is not None else LookupCache()
+        if session is not api.session or lookup_cache is not api.lookup_cache:
+            api = api.__class__(api.api_server, api.api_key, api.api_root, reverse_index=api.reverse_index,
+                                session=session, lookup_cache=lookup_cache)
+        self.api = api
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self._executor = ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _call(self, method, args, kwargs):
+        self.limiter.acquire()
+        return method(*args, **kwargs)
+
+    def submit_shorten(self, long_url, custom_ending=None, is_secret=False):
+        """
+        Starts a :meth:`PolrApi.shorten_result` call.
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._executor.submit(self._call, self.api.shorten_result, (long_url, custom_ending, is_secret), {})
+
+    def submit_lookup(self, lookup_url, url_key=None):
+        """
+        Starts a :meth:`PolrApi.lookup_result` call. Returns a finished future if the result is cached.
+
+        :rtype: concurrent.futures.Future
+        """
+        value = self.api.lookup_cache.get((self.api._get_ending(lookup_url), url_key))
+        if value is not None:
+            future = Future()
+            future.set_result(ApiResult(value, latency=0.0))
+            return future
+        return self._executor.submit(self._call, self.api.lookup_result, (lookup_url, url_key), {})
+
+    def shorten(self, long_url, custom_ending=None, is_secret=False):
+        """
+        Like :meth:`PolrApi.shorten`, but made by the engine. Blocks until done.
+
+        :return: a short link
+        :rtype: str
+        """
+        return self.submit_shorten(long_url, custom_ending, is_secret).result().raise_for_error()
+
+    def lookup(self, lookup_url, url_key=None):
+        """
+        Like :meth:`PolrApi.lookup`, but made by the engine. Blocks until done.
+
+        :return: Lookup dictionary, or False if not found
+        """
+        return self.submit_lookup(lookup_url, url_key).result().raise_for_error()
+
+    def shorten_async(self, long_url, custom_ending=None, is_secret=False, loop=None):
+        """
+        Starts a :meth:`PolrApi.shorten_result` call, and returns an awaitable of its :class:`ApiResult`.
+
+        :param loop: The asyncio event loop that awaits the result. Defaults to the current loop.
+        :rtype: asyncio.Future
+        """
+        import asyncio
+        return asyncio.wrap_future(self.submit_shorten(long_url, custom_ending, is_secret), loop=loop)
+
+    def lookup_async(self, lookup_url, url_key=None, loop=None):
+        """
+        Starts a :meth:`PolrApi.lookup_result` call, and returns an awaitable of its :class:`ApiResult`.
+
+        :param loop: The asyncio event loop that awaits the result. Defaults to the current loop.
+        :rtype: asyncio.Future
+        """
+        import asyncio
+        return asyncio.wrap_future(self.submit_lookup(lookup_url, url_key), loop=loop)
+
+    def close(self, wait=True):
+        """Stops the threads, after finishing calls in progress if ``wait``, and closes the engine's own session."""
+        self._executor.shutdown(wait)
+        if self._session is not None:
+            self._session.close()
@@ -30,6 +30,16 @@ class DebugTempWarning(MypolrError):
         super(DebugTempWarning, self).__init__('This should not happen')
 
 
+class ConfigurationError(MypolrError):
+    """Raised when server or key cannot be found in environment variables or the configuration file.
+
+    :param str profile: the profile that was used
+    """
+    def __init__(self, profile):
+        msg = 'Server and/or key not configured for profile: {}'.format(profile)
+        super(ConfigurationError, self).__init__(msg)
+
+
 class CustomEndingUnavailable(MypolrError):
     """Raised when a custom ending is in use and therefore cannot be created.
 
@@ -0,0 +1,303 @@
+"""
+This file defines the :class:`LoadTest` class, which drives load against a Polr server for capacity planning,
+and the :class:`StubPolrServer` class, a local stand-in for a Polr server.
+
+A load test replays a corpus of long urls, or synthetic urls, as a mix of shortens and lookups of the short urls
+made so far, at a target rate and/or concurrency. The report has the achieved throughput, latency percentiles,
+and the number of errors by :class:`MypolrError` class.
+"""
+from __future__ import division
+
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+from mypolr.rate_limit import RateLimiter
+
+#: Latency percentiles of a report.
+PERCENTILES = (50, 90, 99)
+
+_BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def percentile(sorted_values, p):
+    """
+    Returns the ``p``-th percentile of sorted values by the nearest-rank method, or None if there are no values.
+
+    :param sorted_values: The values, in ascending order.
+    :type sorted_values: list(float)
+    :param float p: Percentile, from 0 to 100.
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(-(-p * len(sorted_values) // 100)), 1)  # Rounded up
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _latency_stats(latencies):
+    latencies = sorted(latencies)
+    stats = dict(('p{}'.format(p), percentile(latencies, p)) for p in PERCENTILES)
+    stats['count'] = len(latencies)
+    stats['max'] = latencies[-1] if latencies else None
+    return stats
+
+
+class LoadTest:
+    """
+    Sends a mix of shortens and lookups to a server from a number of threads, and measures the responses.
+
+    Each lookup is of a short url made earlier in the test, so the first requests are always shortens.
+
+    .. code-block:: python
+
+        api = PolrApi(server_url, api_key, session=requests.Session())
+        report = LoadTest(api, lookup_ratio=0.8, concurrency=16, rate=200).run(duration=60)
+        print(format_report(report))
+
+    :param api: The server to test. Use an api with a session to reuse connections, like most clients would.
+    :type api: PolrApi
+    :param corpus: Long urls to shorten, in order, starting over when all are used.
+                   Synthetic urls are used if None.
+    :type corpus: list(str) or None
+    :param float lookup_ratio: Share of requests that are lookups, from 0 to 1.
+    :param rate: Max requests per second. No limit if None.
+    :type rate: float or None
+    :param int concurrency: Number of threads sending requests.
+    :param progress: Records each request.
+    :type progress: ProgressReporter or None
+    :param seed: Seed of the random choice of operations and urls to look up.
+    """
+    def __init__(self, api, corpus=None, lookup_ratio=0.5, rate=None, concurrency=8, progress=None, seed=None):
+        self.api = api
+        self.corpus = corpus
+        self.lookup_ratio = lookup_ratio
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.progress = progress
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _long_urls(self):
+        if self.corpus:
+            return itertools.cycle(self.corpus)
+        run_id = '{:x}'.format(self._random.getrandbits(32))
+        return ('https://example.com/mypolr-loadtest/{}/{}'.format(run_id, i) for i in itertools.count())
+
+    def run(self, requests=1000, duration=None):
+        """
+        Runs the test until ``requests`` have been sent, or ``duration`` seconds have passed, whichever is first.
+
+        :param requests: Number of requests to send. No limit if None, but then ``duration`` must be given.
+        :type requests: int or None
+        :param duration: Max seconds to run.
+        :type duration: float or None
+        :return: Report with the number of ``requests``, ``elapsed`` seconds, ``throughput`` (requests per second),
+                 ``latency`` (seconds, with ``count``, ``p50``, ``p90``, ``p99`` and ``max``) of all requests and
+                 by ``operations`` (``'shorten'`` and ``'lookup'``), and ``errors`` by error code.
+        :rtype: dict
+        """
+        if requests is None and duration is None:
+            raise ValueError('requests and/or duration must be given')
+        if self.progress is not None:
+            self.progress.total = requests
+            self.progress.concurrency = self.concurrency
+        long_urls = self._long_urls()
+        sent = itertools.count() if requests is None else iter(range(requests))
+        short_urls = []
+        latencies = dict(shorten=[], lookup=[])
+        errors = Counter()
+        start = time.time()
+        deadline = start + duration if duration is not None else None
+
+        def next_operation():
+            """Returns the next operation and its argument, or None when done."""
+            with self._lock:
+                if next(sent, None) is None or (deadline is not None and time.time() >= deadline):
+                    return None
+                if short_urls and self._random.random() < self.lookup_ratio:
+                    return 'lookup', self._random.choice(short_urls)
+                return 'shorten', next(long_urls)
+
+        def work():
+            while True:
+                self.limiter.acquire()
+                operation = next_operation()
+                if operation is None:
+                    return
+                name, argument = operation
+                if name == 'lookup':
+                    result = self.api.lookup_result(argument)
+                    error_code = 'NotFound' if result.value is False else result.error_code
+                else:
+                    result = self.api.shorten_result(argument)
+                    error_code = result.error_code
+                    if result.ok:
+                        short_urls.append(result.value)
+                # list.append() is atomic, so latencies need no lock
+                latencies[name].append(result.latency)
+                if error_code is not None:
+                    with self._lock:
+                        errors[error_code] += 1
+                if self.progress is not None:
+                    self.progress.record(error_code)
+
+        threads = [threading.Thread(target=work, name='mypolr-loadtest-{}'.format(i))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        count = sum(len(values) for values in latencies.values())
+        return dict(requests=count, elapsed=elapsed, throughput=count / elapsed if elapsed > 0 else 0.0,
+                    latency=_latency_stats(latencies['shorten'] + latencies['lookup']),
+                    operations=dict((name, _latency_stats(values)) for name, values in latencies.items()),
+                    errors=dict(errors))
+
+
+def format_report(report):
+    """Returns a load test report as text."""
+    lines = ['{} requests in {:.1f}s: {:.1f} requests/s'.format(report['requests'], report['elapsed'],
+                                                                  report['throughput'])]
+    for name, stats in [('all', report['latency'])] + sorted(report['operations'].items()):
+        if stats['count']:
+            lines.append('{:<8} {:>7} requests, latency ms: {}, max {:.1f}'.format(
+                name, stats['count'],
+                ', '.join('p{} {:.1f}'.format(p, stats['p{}'.format(p)] * 1000) for p in PERCENTILES),
+                stats['max'] * 1000))
+    error_count = sum(report['errors'].values())
+    lines.append('errors   {:>7} ({:.1%})'.format(error_count, error_count / report['requests']
+                                                 if report['requests'] else 0.0))
+    for code, count in sorted(report['errors'].items()):
+        lines.append('  {}: {}'.format(code, count))
+    return '\n'.join(lines)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Accept bursts of new connections from many client threads
+    request_queue_size = 128
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Answers shorten and lookup requests like the Polr API, from the state of the :class:`StubPolrServer`."""
+    # Keep connections alive, like a real server, and send small responses without delay
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency)
+        parts = urlsplit(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(parts.query).items())
+        if params.get('key') != stub.api_key:
+            return self._reply(401, dict(error='Authentication token required.'))
+        if stub.error_rate and random.random() < stub.error_rate:
+            return self._reply(500, dict(error='Internal server error.'))
+        if parts.path.endswith('/action/shorten') and 'url' in params:
+            short_url = stub.shorten(params['url'], params.get('custom_ending'))
+            if short_url is None:
+                return self._reply(400, dict(error='Custom URL already in use.'))
+            return self._reply(200, dict(action='shorten', result=short_url))
+        if parts.path.endswith('/action/lookup') and 'url_ending' in params:
+            long_url = stub.links.get(params['url_ending'])
+            if long_url is None:
+                return self._reply(404, dict(error='Link not found.'))
+            return self._reply(200, dict(action='lookup', result=dict(long_url=long_url, clicks=0)))
+        return self._reply(400, dict(error='Invalid action.'))
+
+    def _reply(self, status_code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPolrServer:
+    """
+    A local HTTP server with the shorten and lookup actions of the Polr API, for load tests and demos.
+
+    Links are kept in memory. Each request is handled by its own thread.
+
+    .. code-block:: python
+
+        with StubPolrServer(latency=0.005) as stub:
+            api = PolrApi(stub.url, stub.api_key)
+            short_url = api.shorten('https://example.com')
+
+    :param str host: Address to listen on.
+    :param int port: Port to listen on. A free port is chosen if 0.
+    :param str api_key: The only key that is accepted.
+    :param float latency: Seconds to wait before answering each request.
+    :param float error_rate: Share of requests, from 0 to 1, answered with HTTP status 500.
+    """
+    def __init__(self, host='127.0.0.1', port=0, api_key='stub_key', latency=0.0, error_rate=0.0):
+        self.api_key = api_key
+        self.latency = latency
+        self.error_rate = error_rate
+        #: Long url of each url ending.
+        self.links = {}
+        self._next_id = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.stub = self
+        host, port = self._server.server_address[:2]
+        #: Url of the server, to use as ``api_server``.
+        self.url = 'http://{}:{}'.format(host, port)
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs=dict(poll_interval=0.1),
+                                        name='mypolr-stub-server')
+        self._thread.daemon = True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _new_ending(self):
+        while True:
+            number = next(self._next_id)
+            ending = ''
+            while number:
+                number, digit = divmod(number, len(_BASE62))
+                ending = _BASE62[digit] + ending
+            if ending not in self.links:
+                return ending
+
+    def shorten(self, long_url, custom_ending=None):
+        """Stores a link and returns its short url, or None if the custom ending is in use."""
+        with self._lock:
+            if custom_ending is None:
+                custom_ending = self._new_ending()
+            elif custom_ending in self.links:
+                return None
+            self.links[custom_ending] = long_url
+        return '{}/{}'.format(self.url, custom_ending)
+
+    def start(self):
+        """Starts serving in a background thread and returns the server."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,115 @@
+"""
+This file defines functions to export short urls from a Polr server, and to migrate them to another server
+with the same custom endings.
+
+Lookups and shortenings are made concurrently by a pool of threads, with an optional rate limit,
+while results are streamed in the order of the given endings.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from mypolr.cache import parse_ending
+from mypolr.rate_limit import RateLimiter
+
+
+def _error_code(lookup):
+    """Returns the error code of a lookup result, with ``'NotFound'`` for a link that does not exist."""
+    if lookup.value is False:
+        return 'NotFound'
+    return lookup.error_code
+
+
+def ordered_map(function, items, workers):
+    """
+    Like ``ThreadPoolExecutor.map()``, but does not consume all items up front, so that items can be streamed.
+
+    At most ``2 * workers`` items are in progress at the same time.
+
+    :param callable function: Called with each item.
+    :param items: The items.
+    :type items: iterable
+    :param int workers: Number of threads.
+    :return: The results, in the order of the items.
+    :rtype: iterator
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def export_links(api, endings, workers=8, rate=None, progress=None):
+    """
+    Looks up short urls concurrently.
+
+    :param api: The server to export from.
+    :type api: PolrApi
+    :param endings: Url endings, with ``/url_key`` appended for secret urls. Empty lines are skipped.
+    :type endings: iterable of str
+    :param int workers: Number of concurrent lookups.
+    :param rate: Max lookups per second. No limit if None.
+    :type rate: float or None
+    :param progress: Records each lookup. A link that is not found counts as an error.
+    :type progress: ProgressReporter or None
+    :return: Tuples of the ending and the :class:`ApiResult` of its lookup, in the order of the endings.
+    :rtype: iterator of tuple(str, ApiResult)
+    """
+    limiter = RateLimiter(rate)
+    if progress is not None:
+        progress.concurrency = workers
+
+    def lookup(line):
+        ending, url_key = parse_ending(line)
+        limiter.acquire()
+        result = api.lookup_result(ending, url_key)
+        if progress is not None:
+            progress.record(_error_code(result))
+        return ending, result
+
+    return ordered_map(lookup, (line for line in endings if line.strip()), workers)
+
+
+def migrate_links(source, target, endings, workers=8, rate=None, dry_run=False, progress=None):
+    """
+    Recreates short urls from one server on another server, with the same custom endings.
+
+    Secret urls are recreated as secret urls, but get a new url key from the target server.
+
+    :param source: The server to migrate from.
+    :type source: PolrApi
+    :param target: The server to migrate to.
+    :type target: PolrApi
+    :param endings: Url endings, with ``/url_key`` appended for secret urls. Empty lines are skipped.
+    :type endings: iterable of str
+    :param int workers: Number of concurrent links in progress.
+    :param rate: Max requests per second, lookups and shortenings together. No limit if None.
+    :type rate: float or None
+    :param bool dry_run: Only look up the links on the source server.
+    :param progress: Records each link, as an error if either the lookup or the shortening failed.
+    :type progress: ProgressReporter or None
+    :return: Tuples of the ending, the :class:`ApiResult` of the source lookup,
+             and the :class:`ApiResult` of the shortening on target (None if dry run or lookup failed).
+    :rtype: iterator of tuple(str, ApiResult, ApiResult or None)
+    """
+    limiter = RateLimiter(rate)
+    if progress is not None:
+        progress.concurrency = workers
+
+    def migrate(line):
+        ending, url_key = parse_ending(line)
+        limiter.acquire()
+        lookup = source.lookup_result(ending, url_key)
+        shortened = None
+        if not dry_run and lookup.value:
+            limiter.acquire()
+            shortened = target.shorten_result(lookup.value.get('long_url'), custom_ending=ending,
+                                              is_secret=url_key is not None)
+        if progress is not None:
+            progress.record(_error_code(lookup) or (shortened.error_code if shortened is not None else None))
+        return ending, lookup, shortened
+
+    return ordered_map(migrate, (line for line in endings if line.strip()), workers)
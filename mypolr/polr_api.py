@@ -1,12 +1,44 @@
 """
 This file defines the main component of the Mypolr package: the :class:`PolrApi` class.
 """
+import time
+
 import requests
 
-from mypolr import exceptions
+try:
+    from urllib.parse import quote_plus, urlencode
+except ImportError:  # Python 2
+    from urllib import quote_plus as _quote_plus, urlencode
+
+    def quote_plus(value):
+        if isinstance(value, unicode):  # noqa: F821
+            value = value.encode('utf-8')
+        return _quote_plus(value)
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as _stdlib_json_loads
+
+        def json_loads(content):
+            # The json module accepts bytes only from Python 3.6
+            return _stdlib_json_loads(content.decode('utf-8'))
+
+from mypolr import config, exceptions
+from mypolr.cache import Prefetcher
+from mypolr.canonical import deduplicate
+from mypolr.results import ApiResult, LinkInfo
 
 DEFAULT_API_ROOT = '/api/v2/'
 
+_timer = getattr(time, 'perf_counter', time.time)
+
+# Error responses which are handled by status code alone, so their body is not decoded
+_STATUS_CODES_WITHOUT_DATA = frozenset([400, 401, 403, 404, 500])
+
 
 class PolrApi:
     """
@@ -15,8 +47,21 @@ class PolrApi:
     :param str api_server: The url to your server with Polr Project installed.
     :param str api_key: The API key associated with a user on the server.
     :param str api_root: API root endpoint.
+    :param reverse_index: Optional index of known short urls, consulted by :meth:`shorten` before any request,
+                          and updated with every successful shorten and lookup.
+    :type reverse_index: ReverseIndex or None
+    :param lookup_cache: Optional cache of lookup results, used by :meth:`lookup` and its variants.
+    :type lookup_cache: LookupCache or None
+    :param session: Optional session to reuse connections between requests. Uses ``requests.get()`` if None.
+                    Session headers, auth and environment settings are read once, when the instance is made.
+    :type session: requests.Session or None
     """
-    def __init__(self, api_server, api_key, api_root=DEFAULT_API_ROOT):
+    #: Function used to decode JSON responses: ``orjson.loads`` or ``ujson.loads`` if installed,
+    #: otherwise ``json.loads``. Can be replaced on a subclass or an instance.
+    json_loads = staticmethod(json_loads)
+
+    def __init__(self, api_server, api_key, api_root=DEFAULT_API_ROOT, reverse_index=None, session=None,
+                 lookup_cache=None):
         # Clean url and paths
         api_root = api_root if api_root.startswith('/') else '/{}'.format(api_root)
         api_root = api_root if api_root.endswith('/') else '{}/'.format(api_root)
@@ -35,22 +80,52 @@ class PolrApi:
             'key': self.api_key,
             'response_type': 'json'
         }
+        # Prepared request urls: endpoint and encoded base params are built once, and only
+        # the encoded values of each call are appended
+        base_query = urlencode(sorted(self._base_params.items()))
+        self._shorten_url = '{}?{}&url='.format(self.api_shorten_endpoint, base_query)
+        self._lookup_url = '{}?{}&url_ending='.format(self.api_lookup_endpoint, base_query)
+        self.reverse_index = reverse_index
+        self.session = session
+        self.lookup_cache = lookup_cache
+        if session is not None:
+            # Merge session headers, auth, hooks and environment settings once instead of for every request
+            self._prepared = session.prepare_request(requests.Request('GET', self.api_base))
+            self._send_kwargs = session.merge_environment_settings(self.api_base, {}, None, None, None)
+
+    @classmethod
+    def from_config(cls, profile=None, path=None, **kwargs):
+        """
+        Creates an instance from environment variables and/or a profile in the configuration file.
+
+        See :func:`mypolr.config.load_config` for how values are found. The file is parsed once per process,
+        and not read at all if ``MYPOLR_SERVER`` and ``MYPOLR_KEY`` are set.
+
+        :param profile: Name of the profile. Defaults to ``MYPOLR_PROFILE``, or the ``[connection]``-section.
+        :type profile: str or None
+        :param path: Path of the configuration file. Defaults to ``~/.mypolr/config.ini``.
+        :type path: str or None
+        :param kwargs: Other arguments to :class:`PolrApi`, e.g. ``lookup_cache``.
+        :rtype: PolrApi
+        :raises ConfigurationError: if server or key is not found.
+        """
+        values = config.load_config(profile, path)
+        if values['api_server'] is None or values['api_key'] is None:
+            raise exceptions.ConfigurationError(config.selected_profile(profile))
+        return cls(values['api_server'], values['api_key'], values['api_root'] or DEFAULT_API_ROOT, **kwargs)
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.api_base)
 
-    def _make_request(self, endpoint, params):
+    def _send(self, endpoint, params):
         """
-        Prepares the request and catches common errors and returns tuple of data and the request response.
+        Like :meth:`_make_request`, but returns errors instead of raising them.
 
-        Read more about error codes: https://docs.polrproject.org/en/latest/developer-guide/api/#http-error-codes
+        Errors are returned as a tuple of exception class and arguments, so that no exception instance
+        (and message) is made unless the caller raises it.
 
-        :param endpoint: full endpoint url
-        :type endpoint: str
-        :param params: parameters for the given endpoint
-        :type params: dict
-        :return: Tuple of response data, and the response instance
-        :rtype: dict, requests.Response
+        :return: Tuple of response data, the response instance, and error; data and response are None upon error.
+        :rtype: dict, requests.Response, tuple(type, tuple) or None
         """
         # params = {
         #     **self._base_params,  # Mind order to allow params to overwrite base params
@@ -58,25 +133,74 @@ class PolrApi:
         # }
         full_params = self._base_params.copy()
         full_params.update(params)
+        query = urlencode([(key, value) for key, value in full_params.items() if value is not None])
+        return self._send_url('{}?{}'.format(endpoint, query), endpoint)
+
+    def _get(self, url):
+        """
+        Sends a GET request to a complete url.
+
+        With a session, the request prepared in ``__init__`` is reused with the new url, which skips parsing and
+        re-encoding of the url, and merging of session and environment settings, for every request.
+        """
+        if self.session is None:
+            return requests.get(url)
+        prepared = requests.PreparedRequest()
+        prepared.method = 'GET'
+        prepared.url = url
+        prepared.headers = self._prepared.headers.copy()
+        prepared.hooks = self._prepared.hooks
+        prepared._cookies = self._prepared._cookies
+        return self.session.send(prepared, **self._send_kwargs)
+
+    def _send_url(self, url, endpoint):
+        """
+        Does the work of :meth:`_send` with a complete request url.
+
+        :param str url: full request url, including the encoded query
+        :param str endpoint: full endpoint url, without query
+        """
         try:
-            r = requests.get(endpoint, full_params)
-            data = r.json()
-            if r.status_code == 401 and not endpoint.endswith('lookup'):
-                raise exceptions.UnauthorizedKeyError
-            elif r.status_code == 400 and not endpoint.endswith('shorten'):
-                raise exceptions.BadApiRequest
-            elif r.status_code == 500:
-                raise exceptions.ServerOrConnectionError
-            return data, r
+            r = self._get(url)
+            # Decode raw bytes directly: skips the encoding detection of r.json(), and bodies that are never used
+            data = None if r.status_code in _STATUS_CODES_WITHOUT_DATA else self.json_loads(r.content)
         except ValueError as e:
-            raise exceptions.BadApiResponse(e)
+            return None, None, (exceptions.BadApiResponse, (e,))
         except requests.RequestException:
-            raise exceptions.ServerOrConnectionError
+            return None, None, (exceptions.ServerOrConnectionError, ())
+        if r.status_code == 401 and not endpoint.endswith('lookup'):
+            return None, r, (exceptions.UnauthorizedKeyError, ())
+        elif r.status_code == 400 and not endpoint.endswith('shorten'):
+            return None, r, (exceptions.BadApiRequest, ())
+        elif r.status_code == 500:
+            return None, r, (exceptions.ServerOrConnectionError, ())
+        return data, r, None
+
+    def _make_request(self, endpoint, params):
+        """
+        Prepares the request and catches common errors and returns tuple of data and the request response.
+
+        Read more about error codes: https://docs.polrproject.org/en/latest/developer-guide/api/#http-error-codes
+
+        :param endpoint: full endpoint url
+        :type endpoint: str
+        :param params: parameters for the given endpoint
+        :type params: dict
+        :return: Tuple of response data, and the response instance
+        :rtype: dict, requests.Response
+        """
+        data, r, error = self._send(endpoint, params)
+        if error is not None:
+            raise error[0](*error[1])
+        return data, r
 
     def shorten(self, long_url, custom_ending=None, is_secret=False):
         """
         Creates a short url if valid
 
+        If a :class:`ReverseIndex` is used, a known short url of a public long url is returned without a request,
+        unless a ``custom_ending`` is given.
+
         :param str long_url: The url to shorten.
         :param custom_ending: The custom url to create if available.
         :type custom_ending: str or None
@@ -84,23 +208,72 @@ class PolrApi:
         :return: a short link
         :rtype: str
         """
-        params = {
-            'url': long_url,
-            'is_secret': 'true' if is_secret else 'false',
-            'custom_ending': custom_ending
-        }
-        data, r = self._make_request(self.api_shorten_endpoint, params)
-        if r.status_code == 400:
+        return _value_or_raise(self._shorten(long_url, custom_ending, is_secret))
+
+    def _shorten(self, long_url, custom_ending=None, is_secret=False):
+        """
+        Does the work of :meth:`shorten`, but returns errors instead of raising them.
+
+        :return: Tuple of short url (None upon error), HTTP status code (None if no request) and error.
+        :rtype: str or None, int or None, tuple(type, tuple) or None
+        """
+        if self.reverse_index is not None and custom_ending is None and not is_secret:
+            short_url = self.reverse_index.get(long_url)
+            if short_url is not None:
+                return short_url, None, None
+        url = self._shorten_url + quote_plus(long_url) + ('&is_secret=true' if is_secret else '&is_secret=false')
+        if custom_ending is not None:
+            url += '&custom_ending=' + quote_plus(custom_ending)
+        data, r, error = self._send_url(url, self.api_shorten_endpoint)
+        status_code = r.status_code if r is not None else None
+        if error is not None:
+            return None, status_code, error
+        if status_code == 400:
             if custom_ending is not None:
-                raise exceptions.CustomEndingUnavailable(custom_ending)
-            raise exceptions.BadApiRequest
-        elif r.status_code == 403:
-            raise exceptions.QuotaExceededError
+                return None, status_code, (exceptions.CustomEndingUnavailable, (custom_ending,))
+            return None, status_code, (exceptions.BadApiRequest, ())
+        elif status_code == 403:
+            return None, status_code, (exceptions.QuotaExceededError, ())
+        elif data is None:
+            # Other status codes without a decoded body, e.g. 404 for a wrong api_root
+            return None, status_code, (exceptions.DebugTempWarning, ())
         action = data.get('action')
         short_url = data.get('result')
         if action == 'shorten' and short_url is not None:
-            return short_url
-        raise exceptions.DebugTempWarning  # TODO: remove after testing
+            if self.reverse_index is not None and not is_secret:
+                self.reverse_index.add(long_url, short_url)
+            return short_url, status_code, None
+        return None, status_code, (exceptions.DebugTempWarning, ())  # TODO: remove after testing
+
+    def shorten_many(self, long_urls, is_secret=False, canonicalizer=None, progress=None):
+        """
+        Creates short urls for many long urls, but sends each unique url to the API only once.
+
+        Pass an :class:`UrlCanonicalizer` to also treat variants of the same destination as duplicates;
+        the first of the urls with the same canonical form is then the one that is shortened.
+
+        :param long_urls: The urls to shorten.
+        :type long_urls: iterable of str
+        :param bool is_secret: if not public, it's secret
+        :param canonicalizer: Function that maps an url to its canonical form. Exact duplicates only if None.
+        :type canonicalizer: UrlCanonicalizer or callable or None
+        :param progress: Records each request to the API. Its ``total`` is set to the number of unique urls if None.
+        :type progress: ProgressReporter or None
+        :return: Short url for each of the given urls, in the same order, or `None` where a module error occurred.
+        :rtype: list(str or None)
+        """
+        unique, positions = deduplicate(long_urls, canonicalizer)
+        if progress is None:
+            short_urls = [self._shorten(long_url, is_secret=is_secret)[0] for long_url in unique]
+        else:
+            if progress.total is None:
+                progress.total = len(unique)
+            short_urls = []
+            for long_url in unique:
+                short_url, _, error = self._shorten(long_url, is_secret=is_secret)
+                short_urls.append(short_url)
+                progress.record(error[0].__name__ if error is not None else None)
+        return [short_urls[index] for index in positions]
 
     def _get_ending(self, lookup_url):
         """
@@ -154,30 +327,147 @@ class PolrApi:
         :return: Lookup dictionary containing, among others things, the long url; or None if not existing
         :rtype: dict or None
         """
+        return _value_or_raise(self._lookup(lookup_url, url_key))
+
+    def _lookup(self, lookup_url, url_key=None, cached=True):
+        """
+        Does the work of :meth:`lookup`, but returns errors instead of raising them.
+
+        :param bool cached: Use the lookup cache, if any. The result is cached either way.
+        :return: Tuple of lookup result (None upon error), HTTP status code (None if no request) and error.
+        :rtype: dict or bool or None, int or None, tuple(type, tuple) or None
+        """
         url_ending = self._get_ending(lookup_url)
-        params = {
-            'url_ending': url_ending,
-            'url_key': url_key
-        }
-        data, r = self._make_request(self.api_lookup_endpoint, params)
-        if r.status_code == 401:
+        cache = self.lookup_cache
+        if cache is not None and cached:
+            value = cache.get((url_ending, url_key))
+            if value is not None:
+                return value, None, None
+        url = self._lookup_url + quote_plus(url_ending)
+        if url_key is not None:
+            url += '&url_key=' + quote_plus(url_key)
+        data, r, error = self._send_url(url, self.api_lookup_endpoint)
+        status_code = r.status_code if r is not None else None
+        if error is not None:
+            return None, status_code, error
+        if status_code == 401:
             if url_key is not None:
-                raise exceptions.UnauthorizedKeyError('given url_key is not valid for secret lookup.')
-            raise exceptions.UnauthorizedKeyError
-        elif r.status_code == 404:
-            return False  # no url found in lookup
+                return None, status_code, (exceptions.UnauthorizedKeyError,
+                                           ('given url_key is not valid for secret lookup.',))
+            return None, status_code, (exceptions.UnauthorizedKeyError, ())
+        elif status_code == 404:
+            if cache is not None:
+                cache.set((url_ending, url_key), False)
+            return False, status_code, None  # no url found in lookup
+        elif status_code == 403:
+            return None, status_code, (exceptions.QuotaExceededError, ())
+        elif data is None:
+            return None, status_code, (exceptions.DebugTempWarning, ())
         action = data.get('action')
         full_url = data.get('result')
         if action == 'lookup' and full_url is not None:
-            return full_url
-        raise exceptions.DebugTempWarning  # TODO: remove after testing
+            if self.reverse_index is not None and url_key is None:
+                self.reverse_index.ingest_lookup('{}/{}'.format(self.api_server, url_ending), full_url)
+            if cache is not None:
+                cache.set((url_ending, url_key), full_url)
+            return full_url, status_code, None
+        return None, status_code, (exceptions.DebugTempWarning, ())  # TODO: remove after testing
+
+    def lookup_info(self, lookup_url, url_key=None):
+        """
+        Calls :meth:`lookup`, but returns a compact :class:`LinkInfo` instead of a dictionary.
+
+        :return: Info about the short url, or False if not existing
+        :rtype: LinkInfo or bool
+        """
+        result = self.lookup(lookup_url, url_key)
+        return LinkInfo.from_lookup(result) if result else result
+
+    def prefetch(self, endings, rate=10.0, refresh_ahead=None, check_interval=1.0):
+        """
+        Warms the lookup cache in the background, and keeps refreshing the entries before they expire.
+
+        The api must have a :class:`LookupCache`; none is added, as that would change the results of
+        all other lookups made with the api.
+
+        .. code-block:: python
+
+            with open('hot_endings.txt') as f:
+                prefetcher = api.prefetch(f, rate=20)
+            prefetcher.warmed.wait(timeout=60)
+
+        :param endings: Url endings to prefetch, e.g. a list or an open file,
+                        with ``/url_key`` appended for secret urls.
+        :type endings: iterable of str
+        :param rate: Max lookups per second. No limit if None.
+        :type rate: float or None
+        :param refresh_ahead: Seconds before expiry when an entry is refreshed. Defaults to 20 % of the cache's ttl.
+        :type refresh_ahead: float or None
+        :param float check_interval: Seconds between checks for entries to refresh.
+        :return: The started prefetcher. Call :meth:`Prefetcher.stop` to stop refreshing.
+        :rtype: Prefetcher
+        :raises ValueError: if the api has no lookup cache.
+        """
+        if self.lookup_cache is None:
+            raise ValueError('prefetch needs a PolrApi with a lookup_cache')
+        return Prefetcher(self, endings, rate, refresh_ahead, check_interval).start()
+
+    def make_engine(self, workers=10, rate=None, lookup_cache=None):
+        """
+        Returns an engine that makes the calls of this api on a pool of threads, for sync and asyncio callers alike.
+
+        The api itself is not changed: if it has no session or lookup cache, the engine uses a copy with its own.
+
+        :param int workers: Max number of concurrent requests.
+        :param rate: Max requests per second. No limit if None.
+        :type rate: float or None
+        :param lookup_cache: Cache of the engine. Defaults to the api's cache, or a new :class:`LookupCache`.
+        :type lookup_cache: LookupCache or None
+        :return: The engine. Call :meth:`ApiEngine.close` when done.
+        :rtype: ApiEngine
+        """
+        # Imported here, so that thread pools are only loaded by users of the engine
+        from mypolr.engine import ApiEngine
+        return ApiEngine(self, workers, rate, lookup_cache)
+
+    def shorten_result(self, long_url, custom_ending=None, is_secret=False):
+        """
+        Calls :meth:`shorten`, but returns an :class:`ApiResult` instead of raising module errors.
+
+        This is cheaper than catching exceptions on code paths with many failures, since no exception is made,
+        while the error class and HTTP status code are still available for diagnosis.
+
+        :rtype: ApiResult
+        """
+        start = _timer()
+        value, status_code, error = self._shorten(long_url, custom_ending, is_secret)
+        return ApiResult(value, error, status_code, _timer() - start)
+
+    def lookup_result(self, lookup_url, url_key=None):
+        """
+        Calls :meth:`lookup`, but returns an :class:`ApiResult` instead of raising module errors.
+
+        The value of a successful result is ``False`` if no url was found.
+
+        :rtype: ApiResult
+        """
+        start = _timer()
+        value, status_code, error = self._lookup(lookup_url, url_key)
+        return ApiResult(value, error, status_code, _timer() - start)
 
-    @exceptions.no_raise
     def shorten_no_raise(self, *args, **kwargs):
         """Calls `PolrApi.shorten(*args, **kwargs)` but returns `None` instead of raising module errors."""
-        return self.shorten(*args, **kwargs)
+        return self.shorten_result(*args, **kwargs).value
 
-    @exceptions.no_raise
     def lookup_no_raise(self, *args, **kwargs):
         """Calls `PolrApi.lookup(*args, **kwargs)` but returns `None` instead of raising module errors."""
-        return self.lookup(*args, **kwargs) or False
+        result = self.lookup_result(*args, **kwargs)
+        return result.value or False if result.ok else None
+
+
+def _value_or_raise(outcome):
+    """Returns the value of a ``(value, status_code, error)``-tuple, or raises the error."""
+    value, _, error = outcome
+    if error is not None:
+        raise error[0](*error[1])
+    return value
@@ -0,0 +1,135 @@
+"""
+This file defines the :class:`ProgressReporter` class, which reports live progress of bulk operations.
+
+Recording progress only updates counters; reports are made at most once per interval, so the reporter can be
+used in the hot loop of bulk jobs.
+"""
+from __future__ import print_function
+
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProgressReporter:
+    """
+    Counts finished items and errors, and reports progress to a stream and/or a callback at a bounded rate.
+
+    A report contains done/total, items per second, error rate and errors by :class:`MypolrError` class,
+    estimated time left, and the current concurrency. Recording is thread-safe.
+
+    .. code-block:: python
+
+        progress = ProgressReporter(total=len(urls), interval=2)
+        short_urls = api.shorten_many(urls, progress=progress)
+
+    :param total: Number of items to process, if known.
+    :type total: int or None
+    :param stream: Stream to write reports to, e.g. ``sys.stderr`` (default). No reports are written if None.
+    :param callback: Function called with the :meth:`snapshot` dictionary for each report.
+    :type callback: callable or None
+    :param float interval: Min seconds between reports.
+    :param clock: Function returning the current time in seconds.
+    :type clock: callable
+    """
+    def __init__(self, total=None, stream=sys.stderr, callback=None, interval=1.0, clock=time.time):
+        self.total = total
+        self.stream = stream
+        self.callback = callback
+        self.interval = interval
+        self.clock = clock
+        self.done = 0
+        #: Number of errors by error code, i.e. the name of the :class:`MypolrError` class.
+        self.errors = Counter()
+        #: Number of concurrent workers. Set by the bulk operation.
+        self.concurrency = 1
+        self.started = clock()
+        self._next_report = self.started + interval
+        self._lock = threading.Lock()
+
+    def record(self, error_code=None):
+        """
+        Records one finished item.
+
+        :param error_code: Name of the error class if the item failed, e.g. :attr:`ApiResult.error_code`.
+        :type error_code: str or None
+        """
+        with self._lock:
+            self.done += 1
+            if error_code is not None:
+                self.errors[error_code] += 1
+        self._maybe_report()
+
+    def add(self, done=0, errors=None):
+        """
+        Records many finished items at once.
+
+        :param int done: Number of finished items, including failed ones.
+        :param errors: Number of errors by error code.
+        :type errors: dict or None
+        """
+        with self._lock:
+            self.done += done
+            if errors:
+                self.errors.update(errors)
+        self._maybe_report()
+
+    def _maybe_report(self):
+        now = self.clock()
+        if now < self._next_report:
+            return
+        with self._lock:
+            # Only one of the threads that see a due report makes it
+            if now < self._next_report:
+                return
+            self._next_report = now + self.interval
+        self.report(schedule=False)
+
+    def snapshot(self):
+        """
+        Returns the current progress.
+
+        :return: Dictionary with ``done``, ``total``, ``elapsed`` (seconds), ``rate`` (items per second),
+                 ``errors`` (by error code), ``error_rate`` (0 to 1), ``eta`` (seconds, or None if unknown)
+                 and ``concurrency``.
+        :rtype: dict
+        """
+        with self._lock:
+            done = self.done
+            errors = dict(self.errors)
+        elapsed = self.clock() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - done) / rate if self.total is not None and rate > 0 else None
+        return dict(done=done, total=self.total, elapsed=elapsed, rate=rate, errors=errors,
+                    error_rate=float(sum(errors.values())) / done if done else 0.0, eta=eta,
+                    concurrency=self.concurrency)
+
+    @staticmethod
+    def format(snapshot):
+        """Returns a snapshot as a one-line text."""
+        done = snapshot['done']
+        if snapshot['total'] is not None:
+            total = snapshot['total']
+            done = '{}/{} ({:.0%})'.format(done, total, float(done) / total if total else 1.0)
+        text = '{} done, {:.1f}/s, {:.1%} errors'.format(done, snapshot['rate'], snapshot['error_rate'])
+        if snapshot['errors']:
+            text += ' ({})'.format(', '.join('{}: {}'.format(code, count)
+                                             for code, count in sorted(snapshot['errors'].items())))
+        if snapshot['eta'] is not None:
+            text += ', ETA {:.0f}s'.format(snapshot['eta'])
+        return text + ', concurrency {}'.format(snapshot['concurrency'])
+
+    def report(self, schedule=True):
+        """Reports progress now, and schedules the next report."""
+        if schedule:
+            self._next_report = self.clock() + self.interval
+        snapshot = self.snapshot()
+        if self.callback is not None:
+            self.callback(snapshot)
+        if self.stream is not None:
+            print(self.format(snapshot), file=self.stream)
+
+    def close(self):
+        """Makes the final report."""
+        self.report()
@@ -0,0 +1,51 @@
+"""
+This file defines the :class:`RateLimiter` class, used to limit the number of requests per second
+across threads, or across processes.
+"""
+import threading
+import time
+
+
+class _Slot:
+    """Alternative to ``multiprocessing.Value`` with the same interface, shared by the threads of one process."""
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
+
+
+class RateLimiter:
+    """
+    Spaces out calls to :meth:`acquire` evenly to not exceed a given rate.
+
+    The limiter keeps the time of the next free slot. Each call reserves a slot and sleeps until it starts,
+    so waiting callers do not hold any lock.
+
+    With ``shared=True``, the slot is kept in shared memory, and the limiter can be passed to processes created with
+    :mod:`multiprocessing` (e.g. as ``initargs`` to a ``Pool``) to have one global rate budget for all of them.
+
+    :param rate: Max number of calls per second. No limit if None or 0.
+    :type rate: float or None
+    :param bool shared: Use shared memory to limit the rate across processes.
+    """
+    def __init__(self, rate, shared=False):
+        self.rate = rate
+        self.interval = 1.0 / rate if rate else 0.0
+        if shared:
+            import multiprocessing
+            self._next_slot = multiprocessing.Value('d', 0.0)
+        else:
+            self._next_slot = _Slot()
+
+    def acquire(self):
+        """Blocks until the caller may proceed. Returns immediately if there is no limit."""
+        if not self.interval:
+            return
+        with self._next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,127 @@
+"""
+This file defines the :class:`ClientRegistry` class, a process-wide store of shared :class:`PolrApi` instances
+for services that use many API keys.
+
+Clients are kept per server, API root and key, and all clients of the same host share one
+``requests.Session``, and thereby one connection pool. Clients that have not been used for a while are evicted.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+from mypolr.polr_api import PolrApi, DEFAULT_API_ROOT
+
+
+def _host(api_server):
+    parts = urlsplit(api_server)
+    return parts.scheme, parts.netloc
+
+
+class ClientRegistry:
+    """
+    Thread-safe registry handing out shared :class:`PolrApi` instances.
+
+    A :class:`PolrApi` does not change after it is made, so one instance can be used by many threads.
+
+    .. code-block:: python
+
+        registry = ClientRegistry(idle_timeout=600, api_kwargs_factory=lambda key: dict(lookup_cache=LookupCache()))
+
+        def handle_request(tenant):
+            api = registry.get(tenant.polr_server, tenant.polr_key)
+            return api.shorten(tenant.url)
+
+    :param float idle_timeout: Seconds a client may be unused before it is evicted.
+    :param int pool_maxsize: Max number of connections kept open per host.
+    :param clock: Function returning the current time in seconds.
+    :type clock: callable
+    :param api_kwargs_factory: Function called with the ``(api_server, api_root, api_key)`` of each new client,
+                               which returns other arguments to its :class:`PolrApi`, e.g. ``lookup_cache``.
+                               Return new objects for each client: a lookup cache or reverse index shared by
+                               clients of different servers would return results of one server to the other.
+    :type api_kwargs_factory: callable or None
+    """
+    def __init__(self, idle_timeout=300.0, pool_maxsize=10, clock=time.time, api_kwargs_factory=None):
+        self.idle_timeout = idle_timeout
+        self.pool_maxsize = pool_maxsize
+        self.clock = clock
+        self.api_kwargs_factory = api_kwargs_factory
+        self._clients = {}  # (api_server, api_root, api_key) -> [PolrApi, last used]
+        self._sessions = {}  # host -> requests.Session
+        self._last_eviction = clock()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _session(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            session = self._sessions[host] = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def get(self, api_server, api_key, api_root=DEFAULT_API_ROOT):
+        """
+        Returns the shared client for a server, key and API root, and makes it if needed.
+
+        Arguments are the same as for :class:`PolrApi`.
+
+        :rtype: PolrApi
+        """
+        key = (api_server.rstrip('/'), '/{}/'.format(api_root.strip('/')), api_key)
+        now = self.clock()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                session = self._session(_host(key[0]))
+                api_kwargs = self.api_kwargs_factory(key) if self.api_kwargs_factory is not None else {}
+                entry = self._clients[key] = [PolrApi(key[0], api_key, key[1], session=session, **api_kwargs), now]
+            else:
+                entry[1] = now
+            if now - self._last_eviction >= self.idle_timeout / 2.0:
+                self._evict(now)
+        return entry[0]
+
+    def _evict(self, now):
+        self._last_eviction = now
+        for key in [key for key, (_, last_used) in self._clients.items() if now - last_used >= self.idle_timeout]:
+            del self._clients[key]
+        hosts_in_use = set(_host(key[0]) for key in self._clients)
+        for host in [host for host in self._sessions if host not in hosts_in_use]:
+            self._sessions.pop(host).close()
+
+    def evict_idle(self):
+        """Removes clients that have been unused for ``idle_timeout`` seconds, and closes unused sessions."""
+        with self._lock:
+            self._evict(self.clock())
+
+    def close(self):
+        """Removes all clients and closes all sessions."""
+        with self._lock:
+            self._clients.clear()
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+#: The registry used by :func:`get_client`.
+default_registry = ClientRegistry()
+
+
+def get_client(api_server, api_key, api_root=DEFAULT_API_ROOT):
+    """
+    Returns a shared client from the process-wide :data:`default_registry`.
+
+    :rtype: PolrApi
+    """
+    return default_registry.get(api_server, api_key, api_root)
@@ -0,0 +1,176 @@
+"""
+This file defines lightweight result types returned by :class:`PolrApi`:
+:class:`ApiResult` instead of raised exceptions, and :class:`LinkInfo` instead of lookup dictionaries.
+"""
+import calendar
+import datetime
+import time
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+_UTC_NAMES = frozenset(['UTC', 'Z', 'GMT', 'Etc/UTC', '+00:00'])
+
+
+class ApiResult(object):
+    """
+    Outcome of an API call, returned by :meth:`PolrApi.shorten_result` and :meth:`PolrApi.lookup_result`.
+
+    Failures keep the :class:`MypolrError` class and its arguments instead of an exception instance,
+    so that no exception or message is made unless :meth:`raise_for_error` or :meth:`exception` is called.
+
+    :param value: The return value of the call, or None upon error.
+    :param error: The :class:`MypolrError`-subclass that would have been raised, and its arguments.
+    :type error: tuple(type, tuple) or None
+    :param status_code: HTTP status code, or None if no response was received.
+    :type status_code: int or None
+    :param float latency: Duration of the call in seconds.
+    """
+    __slots__ = ('ok', 'value', 'error', 'error_args', 'status_code', 'latency')
+
+    def __init__(self, value=None, error=None, status_code=None, latency=None):
+        self.ok = error is None
+        self.value = value
+        self.error, self.error_args = error or (None, ())
+        self.status_code = status_code
+        self.latency = latency
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__  # Python 2
+
+    def __repr__(self):
+        if self.ok:
+            return '{}(ok, {!r})'.format(self.__class__.__name__, self.value)
+        return '{}({}, status_code={})'.format(self.__class__.__name__, self.error_code, self.status_code)
+
+    @property
+    def error_code(self):
+        """Name of the error class, e.g. ``'QuotaExceededError'``, or None if successful."""
+        return self.error.__name__ if self.error is not None else None
+
+    def exception(self):
+        """
+        Makes the exception that would have been raised.
+
+        :rtype: MypolrError or None
+        """
+        return self.error(*self.error_args) if self.error is not None else None
+
+    def raise_for_error(self):
+        """Raises the error, if any, and otherwise returns the value."""
+        if self.error is not None:
+            raise self.exception()
+        return self.value
+
+
+def _parse_timestamp(raw):
+    """Returns epoch seconds from a Polr date string, or from a tuple of date string and timezone."""
+    date, timezone = raw if isinstance(raw, tuple) else (raw, 'UTC')
+    parsed = time.strptime(date[:19], '%Y-%m-%d %H:%M:%S')
+    timestamp = calendar.timegm(parsed)
+    if timezone in _UTC_NAMES:
+        return timestamp
+    if timezone[:1] in '+-':
+        # Offset like +02:00 or -0500
+        digits = timezone[1:].replace(':', '')
+        offset = int(digits[:2]) * 3600 + int(digits[2:4] or 0) * 60
+        return timestamp - offset if timezone[0] == '+' else timestamp + offset
+    if ZoneInfo is not None:
+        try:
+            local = datetime.datetime(*parsed[:6], tzinfo=ZoneInfo(timezone))
+            return timestamp - int(local.utcoffset().total_seconds())
+        except (KeyError, ValueError):
+            pass
+    return timestamp  # Unknown timezones, or any named timezone without zoneinfo, are read as UTC
+
+
+class LinkInfo(object):
+    """
+    Compact record of a lookup result, returned by :meth:`PolrApi.lookup_info`.
+
+    Timestamps are kept as the date strings from the API, and are parsed to epoch seconds on first access.
+    Keys other than ``long_url``, ``clicks``, ``created_at`` and ``updated_at`` are not kept.
+
+    For compatibility with code written for lookup dictionaries, fields can also be read with
+    ``info['long_url']`` or ``info.get('clicks')``, but ``created_at`` and ``updated_at`` are then epoch seconds.
+
+    :param str long_url: The destination of the short url.
+    :param int clicks: Number of clicks.
+    :param created_at: The ``created_at`` value of a lookup result, or epoch seconds.
+    :type created_at: dict or int or None
+    :param updated_at: The ``updated_at`` value of a lookup result, or epoch seconds.
+    :type updated_at: dict or int or None
+    """
+    __slots__ = ('long_url', 'clicks', '_created_at', '_updated_at')
+
+    _fields = ('long_url', 'clicks', 'created_at', 'updated_at')
+
+    def __init__(self, long_url, clicks=0, created_at=None, updated_at=None):
+        self.long_url = long_url
+        self.clicks = clicks
+        self._created_at = self._raw_timestamp(created_at)
+        self._updated_at = self._raw_timestamp(updated_at)
+
+    @classmethod
+    def from_lookup(cls, lookup_result):
+        """
+        Makes a :class:`LinkInfo` from a lookup dictionary as returned by :meth:`PolrApi.lookup`.
+
+        :param dict lookup_result: The lookup result.
+        :rtype: LinkInfo
+        """
+        return cls(lookup_result.get('long_url'), lookup_result.get('clicks', 0),
+                   lookup_result.get('created_at'), lookup_result.get('updated_at'))
+
+    @staticmethod
+    def _raw_timestamp(value):
+        if not isinstance(value, dict):
+            return value
+        timezone = value.get('timezone', 'UTC')
+        return value.get('date') if timezone in _UTC_NAMES else (value.get('date'), timezone)
+
+    def _timestamp(self, slot):
+        value = getattr(self, slot)
+        if value is not None and not isinstance(value, int):
+            value = _parse_timestamp(value)
+            setattr(self, slot, value)
+        return value
+
+    @property
+    def created_at(self):
+        """Creation time in epoch seconds, or None."""
+        return self._timestamp('_created_at')
+
+    @property
+    def updated_at(self):
+        """Time of last update in epoch seconds, or None."""
+        return self._timestamp('_updated_at')
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        """Returns a field like ``dict.get()``, with timestamps as epoch seconds."""
+        value = getattr(self, key, None) if key in self._fields else None
+        return default if value is None else value
+
+    def to_dict(self):
+        """Returns the fields as a dictionary, with timestamps as epoch seconds."""
+        return dict((key, getattr(self, key)) for key in self._fields)
+
+    def __eq__(self, other):
+        return isinstance(other, LinkInfo) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r}, clicks={})'.format(self.__class__.__name__, self.long_url, self.clicks)
@@ -0,0 +1,110 @@
+"""
+This file defines the :class:`ReverseIndex` class, a local index from long urls to existing short urls.
+
+The Polr API only supports lookups from an url ending to the long url. The reverse index is built from
+lookup results and successful shortenings, and lets :class:`PolrApi` skip the network entirely when
+a long url has already been shortened.
+"""
+import binascii
+import hashlib
+import io
+
+#: Number of bytes kept from the hash of each long url.
+DIGEST_SIZE = 16
+
+
+class ReverseIndex:
+    """
+    Maps long urls to short urls in a compact dictionary keyed by a fixed-size hash of the long url.
+
+    Pass an instance to :class:`PolrApi` to make :meth:`PolrApi.shorten` return known short urls without a request:
+
+    .. code-block:: python
+
+        index = ReverseIndex.load('index.txt')
+        api = PolrApi(server_url, api_key, reverse_index=index)
+        api.shorten(long_url)  # no request if long_url has been shortened or looked up before
+        index.save('index.txt')
+
+    :param canonicalizer: Optional function that maps an url to its canonical form before hashing.
+    :type canonicalizer: UrlCanonicalizer or callable or None
+    """
+    def __init__(self, canonicalizer=None):
+        self.canonicalizer = canonicalizer
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, long_url):
+        return self.key(long_url) in self._index
+
+    def key(self, long_url):
+        """
+        Returns the index key of a long url.
+
+        :param str long_url: The long url.
+        :rtype: bytes
+        """
+        if self.canonicalizer is not None:
+            long_url = self.canonicalizer(long_url)
+        return hashlib.sha1(long_url.encode('utf-8')).digest()[:DIGEST_SIZE]
+
+    def add(self, long_url, short_url):
+        """Records that ``long_url`` has been shortened to ``short_url``."""
+        self._index[self.key(long_url)] = short_url
+
+    def get(self, long_url, default=None):
+        """
+        Returns the known short url of a long url.
+
+        :param str long_url: The long url.
+        :param default: Returned if the long url is not in the index.
+        :rtype: str or None
+        """
+        return self._index.get(self.key(long_url), default)
+
+    def short_urls(self):
+        """Returns an iterator over all short urls in the index."""
+        return iter(self._index.values())
+
+    def ingest_lookup(self, short_url, lookup_result):
+        """
+        Adds the result of :meth:`PolrApi.lookup` to the index.
+
+        :param str short_url: The short url that was looked up.
+        :param lookup_result: The lookup result. Ignored unless it contains a long url.
+        :type lookup_result: dict or bool or None
+        """
+        long_url = lookup_result.get('long_url') if lookup_result else None
+        if long_url is not None:
+            self.add(long_url, short_url)
+
+    def save(self, path):
+        """
+        Writes the index to a file, one hex-encoded key and short url per line.
+
+        :param str path: The file to write.
+        """
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for key, short_url in self._index.items():
+                f.write(u'{} {}\n'.format(binascii.hexlify(key).decode('ascii'), short_url))
+
+    @classmethod
+    def load(cls, path, canonicalizer=None):
+        """
+        Reads an index written by :meth:`save`.
+
+        :param str path: The file to read.
+        :param canonicalizer: Must be the same as when the index was built, or keys will not match.
+        :type canonicalizer: UrlCanonicalizer or callable or None
+        :rtype: ReverseIndex
+        """
+        index = cls(canonicalizer)
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                key, _, short_url = line.rstrip('\n').partition(' ')
+                if short_url:
+                    index._index[binascii.unhexlify(key)] = short_url
+        return index
+
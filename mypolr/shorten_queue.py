@@ -0,0 +1,229 @@
+"""
+This file defines the :class:`ShortenQueue` class: a durable write-behind queue for shorten requests.
+
+Shorten requests are stored in a local SQLite database as soon as they are enqueued, and are drained to the
+Polr server in batches by a background worker. While the server is unreachable, the worker backs off
+exponentially and keeps the requests on disk, so callers are never blocked by an outage.
+"""
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+
+from mypolr import exceptions
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+#: Errors that indicate that the server is (temporarily) unavailable, or that the per-minute API quota is used up.
+#: Requests are retried after a backoff.
+TRANSIENT_ERRORS = (exceptions.ServerOrConnectionError, exceptions.BadApiResponse, exceptions.QuotaExceededError)
+
+logger = logging.getLogger(__name__)
+
+JobState = namedtuple('JobState', 'status short_url error')
+"""State of an enqueued shorten request: ``status`` is one of ``'pending'``, ``'done'`` or ``'failed'``."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shorten_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    long_url TEXT NOT NULL,
+    custom_ending TEXT,
+    is_secret INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    short_url TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class ShortenQueue:
+    """
+    Durable queue that shortens urls in the background with a :class:`PolrApi` instance.
+
+    Use :meth:`enqueue` to add a request, and either :meth:`poll` its state or pass a ``callback`` that is called
+    with ``(job_id, JobState)`` from the worker thread when the request is done or has failed.
+    Requests that are still pending when the queue is closed are processed the next time a queue is opened
+    on the same ``path``. Callbacks are not persisted, and exceptions raised by callbacks are logged and ignored.
+
+    :param api: The api used to shorten urls.
+    :type api: PolrApi
+    :param str path: Path to the SQLite database file. The default, ``':memory:'``, is not durable.
+    :param int batch_size: Max number of requests sent per batch.
+    :param float min_backoff: Seconds to wait after the first failed attempt to reach the server.
+    :param float max_backoff: Upper limit of the exponential backoff in seconds.
+    :param float poll_interval: Seconds the idle worker waits for new requests before checking the database again.
+    :param max_attempts: Number of attempts after which a request that keeps getting a transient or unexpected
+                         error is marked as failed, so that it does not block the requests behind it.
+                         No limit if None.
+    :type max_attempts: int or None
+    """
+    def __init__(self, api, path=':memory:', batch_size=50, min_backoff=1.0, max_backoff=300.0, poll_interval=5.0,
+                 max_attempts=10):
+        self.api = api
+        self.path = path
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # Current backoff in seconds; 0 while the server is reachable
+        self.backoff = 0
+        self._callbacks = {}
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            # Keep enqueue cheap: write-ahead log without a full fsync per commit
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def enqueue(self, long_url, custom_ending=None, is_secret=False, callback=None):
+        """
+        Stores a shorten request and returns immediately.
+
+        Arguments are the same as for :meth:`PolrApi.shorten`.
+
+        :param callback: Optional function called as ``callback(job_id, state)`` when the request is finished.
+        :type callback: callable or None
+        :return: The id of the job, to be used with :meth:`poll`.
+        :rtype: int
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO shorten_queue (long_url, custom_ending, is_secret, status) VALUES (?, ?, ?, ?)',
+                (long_url, custom_ending, int(bool(is_secret)), PENDING)
+            )
+            self._db.commit()
+            job_id = cursor.lastrowid
+            if callback is not None:
+                self._callbacks[job_id] = callback
+        self._wakeup.set()
+        return job_id
+
+    def poll(self, job_id):
+        """
+        Returns the state of a job, or None if the job is unknown.
+
+        :param int job_id: Id returned by :meth:`enqueue`.
+        :rtype: JobState or None
+        """
+        with self._lock:
+            row = self._db.execute('SELECT status, short_url, error FROM shorten_queue WHERE id = ?',
+                                   (job_id,)).fetchone()
+        return JobState(*row) if row is not None else None
+
+    def pending_count(self):
+        """Returns the number of requests that have not been sent successfully yet."""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM shorten_queue WHERE status = ?', (PENDING,)).fetchone()[0]
+
+    def _finish(self, job_id, status, short_url=None, error=None):
+        with self._lock:
+            self._db.execute('UPDATE shorten_queue SET status = ?, short_url = ?, error = ?, attempts = attempts + 1 '
+                             'WHERE id = ?', (status, short_url, error, job_id))
+            self._db.commit()
+            callback = self._callbacks.pop(job_id, None)
+        if callback is not None:
+            try:
+                callback(job_id, JobState(status, short_url, error))
+            except Exception:
+                logger.exception('Callback of shorten job %s failed', job_id)
+
+    def drain(self):
+        """
+        Sends one batch of pending requests to the server.
+
+        This is what the background worker calls repeatedly, but it can also be used directly without starting it.
+        If the server cannot be reached, the batch is aborted and :attr:`backoff` is increased.
+        A request is marked as failed when it has been attempted ``max_attempts`` times.
+
+        :return: Number of requests that were completed (done or failed) in this batch.
+        :rtype: int
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT id, long_url, custom_ending, is_secret, attempts FROM shorten_queue '
+                                    'WHERE status = ? ORDER BY id LIMIT ?', (PENDING, self.batch_size)).fetchall()
+        completed = 0
+        for job_id, long_url, custom_ending, is_secret, attempts in rows:
+            try:
+                short_url = self.api.shorten(long_url, custom_ending=custom_ending, is_secret=bool(is_secret))
+            except TRANSIENT_ERRORS as e:
+                completed += self._retry_later(job_id, attempts, str(e))
+                break
+            except exceptions.MypolrError as e:
+                self._finish(job_id, FAILED, error=str(e))
+            except Exception as e:
+                # Unexpected errors are retried too, but count as attempts so that the job cannot block the queue
+                logger.exception('Shorten job %s raised an unexpected error', job_id)
+                completed += self._retry_later(job_id, attempts, repr(e))
+                break
+            else:
+                self._finish(job_id, DONE, short_url=short_url)
+            self.backoff = 0
+            completed += 1
+        return completed
+
+    def _retry_later(self, job_id, attempts, error):
+        """Counts a failed attempt and backs off, or fails the job after ``max_attempts``. Returns 1 if failed."""
+        self._increase_backoff()
+        if self.max_attempts is not None and attempts + 1 >= self.max_attempts:
+            self._finish(job_id, FAILED, error=error)
+            return 1
+        with self._lock:
+            self._db.execute('UPDATE shorten_queue SET attempts = attempts + 1 WHERE id = ?', (job_id,))
+            self._db.commit()
+        return 0
+
+    def _increase_backoff(self):
+        self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                completed = self.drain()
+            except Exception:
+                # Keep the worker alive, e.g. if the database is locked
+                logger.exception('Draining the shorten queue failed')
+                self._increase_backoff()
+                completed = 0
+            if self.backoff:
+                self._stopping.wait(self.backoff)
+            elif not completed:
+                self._wakeup.wait(self.poll_interval)
+
+    def start(self):
+        """Starts the background worker thread, unless already running, and returns the queue itself."""
+        if self._worker is None or not self._worker.is_alive():
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name='mypolr-shorten-queue')
+            self._worker.daemon = True
+            self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the background worker. Pending requests stay in the database."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def close(self):
+        """Stops the worker and closes the database."""
+        self.stop()
+        with self._lock:
+            self._db.close()
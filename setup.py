@@ -36,7 +36,11 @@ setup(
     keywords='polr-project shorturl api',
     description=short_description,
     long_description=long_description,
-    install_requires=['requests'],
+    install_requires=['requests', 'futures; python_version < "3"'],
+    extras_require={
+        # Faster decoding of API responses
+        'fastjson': ['orjson; python_version >= "3.6"', 'ujson; python_version < "3.6"'],
+    },
     python_requires='>=2.7,!=3.0.*,!=3.1.*,!=3.2.*',  # 2.7 or 3.3+
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the per-call overhead of :meth:`PolrApi.shorten`, without any network traffic.
+
+Both variants use a session with an adapter that returns a canned response, so only the work done by
+mypolr and requests is measured:
+
+ - ``params_dict``: the original construction; copy and update of the params dict, and params encoded
+   and merged with session settings by ``requests`` for every call.
+ - ``prepared_url``: :meth:`PolrApi.shorten`, which appends only the encoded values to a precomputed url,
+   and reuses the request prepared when the :class:`PolrApi` was made.
+
+Run from project root with ``python tests/bench_request_construction.py``.
+"""
+from __future__ import print_function
+
+import timeit
+
+import requests
+from requests.adapters import BaseAdapter
+
+from mypolr import PolrApi
+
+long_url = 'https://stackoverflow.com/questions/tagged/python?sort=newest&page=2'
+body = b'{"action": "shorten", "result": "https://ti.ny/abcd"}'
+
+
+class CannedAdapter(BaseAdapter):
+    """Returns the same successful shorten response to every request."""
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def make_session():
+    session = requests.Session()
+    session.mount('https://', CannedAdapter())
+    return session
+
+
+api = PolrApi('https://ti.ny', 'abcdef1234567890', session=make_session())
+old_session = make_session()
+
+
+def params_dict():
+    params = {
+        'url': long_url,
+        'is_secret': 'false',
+        'custom_ending': None
+    }
+    full_params = api._base_params.copy()
+    full_params.update(params)
+    r = old_session.get(api.api_shorten_endpoint, params=full_params)
+    return r.json().get('result')
+
+
+def prepared_url():
+    return api.shorten(long_url)
+
+
+def main(number=5000):
+    assert params_dict() == prepared_url()
+    results = {}
+    for f in (params_dict, prepared_url):
+        results[f] = min(timeit.repeat(f, number=number, repeat=5)) / number * 1e6
+        print('{:<14} {:6.1f} us per call'.format(f.__name__, results[f]))
+    print('Overhead reduced by {:.0%}'.format(1 - results[prepared_url] / results[params_dict]))
+
+
+if __name__ == '__main__':
+    main()
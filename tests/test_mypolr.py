@@ -158,6 +158,46 @@ class TestMakeRequest:
 
         rmap.make_error_tests(api._make_request, endpoint, {})
 
+    def test_error_status_without_json(self):
+        rmap = ResponseErrorMap(api.api_shorten_endpoint)
+        rmap.add(dict(status=403, body='<html>Forbidden</html>'), polr_errors.QuotaExceededError)
+        rmap.add(dict(status=502, body='<html>Bad Gateway</html>'), polr_errors.BadApiResponse)
+        rmap.add(dict(status=404, body='<html>Not Found</html>'), polr_errors.DebugTempWarning)
+        rmap.make_error_tests(api.shorten, long_url)
+
+        rmap = ResponseErrorMap(api.api_lookup_endpoint)
+        rmap.add(dict(status=403, body='<html>Forbidden</html>'), polr_errors.QuotaExceededError)
+        rmap.make_error_tests(api.lookup, 'abcd')
+
+    @responses.activate
+    def test_error_status_without_json_no_raise(self):
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=403)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=404)
+        assert api.lookup_result('abcd').error_code == 'QuotaExceededError'
+        assert api.lookup_no_raise('abcd') is None
+        assert api.shorten_result(long_url).error_code == 'DebugTempWarning'
+
+    @responses.activate
+    def test_custom_json_decoder(self):
+        decoded = []
+
+        class DecodingApi(PolrApi):
+            @staticmethod
+            def json_loads(content):
+                decoded.append(content)
+                return json_action('shorten', short_url)
+
+        responses.add('GET', api.api_shorten_endpoint, body=b'{}', status=200)
+        assert DecodingApi(api_server, api_key).shorten(long_url) == short_url
+        assert decoded == [b'{}']
+
+    def test_default_json_decoder(self):
+        # Any backend must decode the raw bytes of a response, and raise ValueError for invalid bodies
+        assert PolrApi.json_loads(u'{"result": "\u00e6"}'.encode('utf-8')) == {'result': u'\u00e6'}
+        for body in (b'not JSON', b'"\xff"'):
+            with pytest.raises(ValueError):
+                PolrApi.json_loads(body)
+
 
 class TestShorten:
     @responses.activate
@@ -226,3 +266,822 @@ class TestCliArgs:
         for kw in bool_kws:
             assert kw in args
             assert getattr(args, kw) is True
+
+
+class TestShortenQueue:
+    @responses.activate
+    def test_drain(self):
+        from mypolr.shorten_queue import ShortenQueue, DONE, FAILED, PENDING
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=400)
+        finished = []
+        queue = ShortenQueue(api)
+        first = queue.enqueue(long_url, callback=lambda job_id, state: finished.append((job_id, state.status)))
+        second = queue.enqueue(long_url, custom_ending='taken')
+        assert queue.poll(first).status == PENDING
+        assert queue.pending_count() == 2
+
+        assert queue.drain() == 2
+        assert queue.poll(first) == (DONE, short_url, None)
+        assert queue.poll(second).status == FAILED
+        assert 'taken' in queue.poll(second).error
+        assert finished == [(first, DONE)]
+        assert queue.poll(42) is None
+        queue.close()
+
+    @responses.activate
+    def test_backoff_during_outage(self):
+        from mypolr.shorten_queue import ShortenQueue, DONE, PENDING
+
+        responses.add('GET', api.api_shorten_endpoint, body=requests.ConnectionError())
+        queue = ShortenQueue(api, min_backoff=1, max_backoff=3)
+        job_id = queue.enqueue(long_url)
+        backoffs = []
+        for _ in range(3):
+            assert queue.drain() == 0
+            backoffs.append(queue.backoff)
+        assert backoffs == [1, 2, 3]
+        assert queue.poll(job_id).status == PENDING
+
+        responses.replace('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        assert queue.drain() == 1
+        assert queue.backoff == 0
+        assert queue.poll(job_id).status == DONE
+        queue.close()
+
+    @responses.activate
+    def test_max_attempts(self):
+        from mypolr.shorten_queue import ShortenQueue, DONE, FAILED, PENDING
+
+        for _ in range(2):
+            responses.add('GET', api.api_shorten_endpoint, json={}, status=500)
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        queue = ShortenQueue(api, max_attempts=2)
+        blocked = queue.enqueue(long_url)
+        behind = queue.enqueue(long_url)
+        assert queue.drain() == 0
+        assert queue.poll(blocked).status == PENDING
+        assert queue.drain() == 1  # Second attempt fails the request, and stops the batch
+        assert queue.poll(blocked).status == FAILED
+        assert queue.poll(behind).status == PENDING
+        assert queue.drain() == 1
+        assert queue.poll(behind).status == DONE
+        queue.close()
+
+    @responses.activate
+    def test_quota_and_unexpected_errors(self):
+        from mypolr.shorten_queue import ShortenQueue, DONE, FAILED, PENDING
+
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        queue = ShortenQueue(api, max_attempts=2)
+        job_id = queue.enqueue(long_url)
+        assert queue.drain() == 0 and queue.backoff > 0  # Quota is per minute: back off instead of failing
+        assert queue.poll(job_id).status == PENDING
+        assert queue.drain() == 1 and queue.poll(job_id).status == DONE
+
+        class BrokenApi:
+            def shorten(self, *args, **kwargs):
+                raise TypeError('bad row')
+
+        queue.api = BrokenApi()
+        job_id = queue.enqueue(long_url)
+        assert queue.drain() == 0 and queue.poll(job_id).status == PENDING
+        assert queue.drain() == 1
+        assert queue.poll(job_id).status == FAILED and 'bad row' in queue.poll(job_id).error
+        queue.close()
+
+    @responses.activate
+    def test_failing_callback(self):
+        import threading
+        from mypolr.shorten_queue import ShortenQueue, DONE
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        done = threading.Event()
+        with ShortenQueue(api) as queue:
+            queue.enqueue(long_url, callback=lambda *args: 1 / 0)
+            job_id = queue.enqueue(long_url, callback=lambda *args: done.set())
+            assert done.wait(5)
+            assert queue.poll(job_id).status == DONE
+            assert queue._worker.is_alive()
+
+    @responses.activate
+    def test_durable_worker(self, tmpdir):
+        import threading
+        from mypolr.shorten_queue import ShortenQueue, DONE
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        path = str(tmpdir.join('queue.db'))
+        queue = ShortenQueue(api, path)
+        job_id = queue.enqueue(long_url)
+        queue.close()
+
+        done = threading.Event()
+        with ShortenQueue(api, path) as queue:
+            queue.enqueue(long_url, callback=lambda *args: done.set())
+            assert done.wait(5)
+            assert queue.poll(job_id).status == DONE
+
+
+class TestCanonical:
+    def test_canonicalizer(self):
+        from mypolr.canonical import UrlCanonicalizer
+
+        canonical = UrlCanonicalizer()
+        assert canonical('HTTPS://Example.COM:443/a/b/?b=2&utm_source=x&a=1#top') == 'https://example.com/a/b?a=1&b=2'
+        assert canonical('http://example.com') == 'http://example.com/'
+        assert canonical('http://example.com:8080/') == 'http://example.com:8080/'
+        assert canonical('http://user@[::1]:80/x?fbclid=1') == 'http://user@[::1]/x'
+
+        keep_all = UrlCanonicalizer(strip_params=(), sort_query=False, drop_fragment=False, strip_trailing_slash=False)
+        assert keep_all('http://Example.com/a/?b=2&utm_x=1#f') == 'http://example.com/a/?b=2&utm_x=1#f'
+
+        # Repeated parameters keep their order
+        assert canonical('http://a.com/?tag=b&x=1&tag=a') == 'http://a.com/?tag=b&tag=a&x=1'
+        assert canonical('http://a.com/?tag=b&tag=a') != canonical('http://a.com/?tag=a&tag=b')
+
+    def test_deduplicate(self):
+        from mypolr.canonical import UrlCanonicalizer, deduplicate
+
+        urls = ['http://a.com/x', 'http://A.com/x/', 'http://b.com', 'http://a.com/x']
+        assert deduplicate(urls) == (['http://a.com/x', 'http://A.com/x/', 'http://b.com'], [0, 1, 2, 0])
+        assert deduplicate(urls, UrlCanonicalizer()) == (['http://a.com/x', 'http://b.com'], [0, 0, 1, 0])
+
+    @responses.activate
+    def test_shorten_many(self):
+        from mypolr.canonical import UrlCanonicalizer
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        urls = [long_url, long_url + '/?utm_campaign=x', 'https://other.example.com']
+        assert api.shorten_many(urls, canonicalizer=UrlCanonicalizer()) == [short_url, short_url, None]
+        assert len(responses.calls) == 2
+
+
+class TestReverseIndex:
+    def test_index(self, tmpdir):
+        from mypolr.canonical import UrlCanonicalizer
+        from mypolr.reverse_index import ReverseIndex, DIGEST_SIZE
+
+        index = ReverseIndex(UrlCanonicalizer())
+        index.add(long_url, short_url)
+        index.ingest_lookup(api_server + '/other', dict(long_url='https://other.example.com'))
+        index.ingest_lookup(api_server + '/missing', False)
+        assert len(index) == 2
+        assert long_url + '/?utm_source=x' in index
+        assert index.get('https://other.example.com') == api_server + '/other'
+        assert index.get('https://unknown.example.com') is None
+        assert all(len(key) == DIGEST_SIZE for key in index._index)
+
+        path = str(tmpdir.join('index.txt'))
+        index.save(path)
+        loaded = ReverseIndex.load(path, UrlCanonicalizer())
+        assert loaded._index == index._index
+
+    @responses.activate
+    def test_api_uses_index(self):
+        from mypolr.reverse_index import ReverseIndex
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json=json_action('lookup', dict(long_url='https://b.com')))
+        indexed_api = PolrApi(api_server, api_key, reverse_index=ReverseIndex())
+        assert indexed_api.shorten(long_url) == short_url
+        assert indexed_api.shorten(long_url) == short_url
+        assert len(responses.calls) == 1
+        # Secret and custom urls are always requested
+        indexed_api.shorten(long_url, is_secret=True)
+        indexed_api.shorten(long_url, custom_ending='custom')
+        assert len(responses.calls) == 3
+
+        indexed_api.lookup('b')
+        assert indexed_api.reverse_index.get('https://b.com') == api_server + '/b'
+
+
+class TestApiResult:
+    @responses.activate
+    def test_results(self):
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        responses.add('GET', api.api_shorten_endpoint, body=requests.ConnectionError())
+
+        result = api.shorten_result(long_url)
+        assert result.ok and result
+        assert result.value == short_url
+        assert result.status_code == 200
+        assert result.error_code is None
+        assert result.latency >= 0
+        assert result.raise_for_error() == short_url
+
+        result = api.shorten_result(long_url)
+        assert not result
+        assert result.value is None
+        assert result.status_code == 403
+        assert result.error_code == 'QuotaExceededError'
+        assert isinstance(result.exception(), polr_errors.QuotaExceededError)
+        with pytest.raises(polr_errors.QuotaExceededError):
+            result.raise_for_error()
+
+        result = api.shorten_result(long_url)
+        assert (result.error, result.status_code) == (polr_errors.ServerOrConnectionError, None)
+        assert not hasattr(result, '__dict__')
+
+    @responses.activate
+    def test_lookup_results(self):
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=401)
+
+        result = api.lookup_result('abcd')
+        assert result.ok and result.value is False
+        result = api.lookup_result('abcd', url_key='a_secret')
+        assert result.error_code == 'UnauthorizedKeyError'
+        assert 'url_key' in str(result.exception())
+
+    @responses.activate
+    def test_no_raise(self):
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=401)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=400)
+        assert api.lookup_no_raise('abcd') is False
+        assert api.lookup_no_raise('abcd') is None
+        assert api.shorten_no_raise(long_url) is None
+
+
+class TestLinkInfo:
+    lookup_dict = dict(
+        long_url=long_url,
+        clicks=42,
+        created_at=dict(date='2017-12-03 00:40:45.000000', timezone='UTC', timezone_type=3),
+        updated_at=dict(date='2017-12-03 02:40:45.000000', timezone='+02:00', timezone_type=1),
+    )
+
+    def test_link_info(self):
+        from mypolr.results import LinkInfo
+
+        info = LinkInfo.from_lookup(self.lookup_dict)
+        assert info.created_at == 1512261645
+        assert info.updated_at == 1512261645
+        assert info['long_url'] == info.get('long_url') == long_url
+        assert info.get('clicks') == 42
+        assert info.get('unknown', 'default') == 'default'
+        with pytest.raises(KeyError):
+            info['unknown']
+        assert info.to_dict() == dict(long_url=long_url, clicks=42, created_at=1512261645, updated_at=1512261645)
+        assert info == LinkInfo(long_url, 42, 1512261645, 1512261645)
+        assert LinkInfo(long_url).created_at is None
+        assert not hasattr(info, '__dict__')
+
+    @responses.activate
+    def test_lookup_info(self):
+        from mypolr.results import LinkInfo
+
+        responses.add('GET', api.api_lookup_endpoint, json=json_action('lookup', self.lookup_dict), status=200)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        assert api.lookup_info('abcd') == LinkInfo.from_lookup(self.lookup_dict)
+        assert api.lookup_info('abcd') is False
+
+
+class TestBulkRunner:
+    def test_shard_file(self, tmpdir):
+        from mypolr.bulk import shard_file, read_shard
+
+        path = tmpdir.join('urls.txt')
+        lines = ['https://example.com/{}'.format(i) for i in range(100)]
+        path.write('\n'.join(lines) + '\n\n')
+        shards = shard_file(str(path), 7)
+        assert len(shards) == 7
+        assert shards[0][0] == 0 and shards[-1][1] == path.size()
+        assert all(a[1] == b[0] for a, b in zip(shards, shards[1:]))
+        assert [line for start, end in shards for line in read_shard(str(path), start, end)] == lines
+        assert len(shard_file(str(path), 1000)) <= 101
+
+    @responses.activate
+    def test_run_in_process(self, tmpdir):
+        from mypolr.bulk import BulkRunner
+        from mypolr.canonical import UrlCanonicalizer
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        input_path = tmpdir.join('urls.txt')
+        input_path.write('{0}\n{0}/?utm_source=x\nhttps://other.example.com\n'.format(long_url))
+        output_path = tmpdir.join('out.tsv')
+
+        runner = BulkRunner(api, processes=1, canonicalizer=UrlCanonicalizer(), shards_per_process=1)
+        assert runner.run(str(input_path), str(output_path)) == dict(urls=3, errors=1)
+        assert output_path.read().splitlines() == [
+            '{}\t{}\t'.format(long_url, short_url),
+            '{}/?utm_source=x\t{}\t'.format(long_url, short_url),
+            'https://other.example.com\t\tQuotaExceededError',
+        ]
+        assert len(responses.calls) == 2
+        assert sorted(tmpdir.listdir()) == sorted([input_path, output_path])
+
+    @responses.activate
+    def test_duplicates_across_shards(self, tmpdir):
+        from mypolr.bulk import BulkRunner
+        from mypolr.canonical import UrlCanonicalizer
+        from mypolr.progress import ProgressReporter
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        lines = ['https://example.com/{}'.format(i % 3) for i in range(30)] + ['https://example.com/1?utm_source=x']
+        input_path = tmpdir.join('urls.txt')
+        input_path.write('\n'.join(lines) + '\n')
+        output_path = tmpdir.join('out.tsv')
+
+        progress = ProgressReporter(stream=None)
+        runner = BulkRunner(api, processes=1, canonicalizer=UrlCanonicalizer(), shards_per_process=8,
+                            progress=progress)
+        assert runner.run(str(input_path), str(output_path)) == dict(urls=31, errors=0)
+        assert output_path.read().splitlines() == ['{}\t{}\t'.format(line, short_url) for line in lines]
+        assert len(responses.calls) == 3
+        assert (progress.done, progress.total) == (31, 31)
+
+    def test_shared_rate_limiter(self):
+        import time
+        from mypolr.rate_limit import RateLimiter
+
+        for shared in (False, True):
+            limiter = RateLimiter(100, shared=shared)
+            start = time.time()
+            for _ in range(6):
+                limiter.acquire()
+            assert time.time() - start >= 0.05
+        RateLimiter(None).acquire()
+
+    def test_import_without_multiprocessing(self):
+        import subprocess
+        import sys
+
+        code = 'import sys, mypolr; sys.exit("multiprocessing" in sys.modules)'
+        assert subprocess.call([sys.executable, '-c', code]) == 0
+
+
+class TestEndingAllocator:
+    def test_pattern_candidates(self):
+        from itertools import islice
+        from mypolr.endings import pattern_candidates
+
+        assert list(islice(pattern_candidates('sale-{n}', start=3), 2)) == ['sale-3', 'sale-4']
+        assert all(len(ending) == 9 for ending in islice(pattern_candidates('sale-{rand}'), 5))
+
+    def test_unicode_pattern(self):
+        from itertools import islice
+        from mypolr.endings import EndingAllocator
+
+        assert list(islice(EndingAllocator._candidates(u'sale-{n}'), 2)) == ['sale-1', 'sale-2']
+        assert list(EndingAllocator._candidates(['a', 'b'])) == ['a', 'b']
+
+    @responses.activate
+    def test_allocate(self):
+        from mypolr.endings import EndingAllocator
+        from mypolr.reverse_index import ReverseIndex
+
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=400)
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        index = ReverseIndex()
+        index.add('https://a.com', api_server + '/sale-2')
+        allocator = EndingAllocator(api, used_endings=['sale-1'])
+        allocator.seed_from_index(index)
+        allocator.seed_from_lookup(api_server + '/sale-4/secretkey', dict(long_url='https://b.com'))
+        allocator.seed_from_lookup('sale-5', False)
+
+        assert allocator.allocate(long_url, 'sale-{n}') == short_url
+        tried = [call.request.url for call in responses.calls]
+        assert len(tried) == 2
+        assert 'custom_ending=sale-3' in tried[0] and 'custom_ending=sale-5' in tried[1]
+        assert 'sale-3' in allocator and 'sale-5' in allocator
+
+    @responses.activate
+    def test_allocate_errors(self):
+        from mypolr.endings import EndingAllocator
+
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=400)
+        allocator = EndingAllocator(api, used_endings=['a'], max_attempts=2)
+        with pytest.raises(polr_errors.CustomEndingUnavailable):
+            allocator.allocate(long_url, ['a', 'b', 'c', 'd'])
+        assert len(responses.calls) == 2
+        with pytest.raises(polr_errors.CustomEndingUnavailable):
+            allocator.allocate(long_url, 'same')
+
+        responses.replace('GET', api.api_shorten_endpoint, json={}, status=403)
+        with pytest.raises(polr_errors.QuotaExceededError):
+            allocator.allocate(long_url, ['e'])
+        assert 'e' not in allocator
+
+    @responses.activate
+    def test_allocate_many(self):
+        from mypolr.endings import EndingAllocator
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        allocator = EndingAllocator(api, used_endings=['x2'])
+        results = allocator.allocate_many(['https://{}.com'.format(i) for i in range(5)], 'x{n}')
+        assert all(result.value == short_url for result in results)
+        endings = sorted(call.request.url.split('custom_ending=')[1].split('&')[0] for call in responses.calls)
+        assert endings == ['x1', 'x3', 'x4', 'x5', 'x6']
+
+
+class TestMigrate:
+    @responses.activate
+    def test_export_and_migrate(self):
+        from mypolr.migrate import export_links, migrate_links
+
+        target = PolrApi('https://ta.rget', api_key)
+        lookup_url = api.api_lookup_endpoint
+        responses.add('GET', lookup_url, json=lookup_resp, status=200)
+        responses.add('GET', target.api_shorten_endpoint, json=shorten_resp, status=200)
+
+        exported = list(export_links(api, ['a', '', 'b/key\n'], workers=2))
+        assert [(ending, result.value) for ending, result in exported] == [('a', lookup_resp['result']),
+                                                                          ('b', lookup_resp['result'])]
+        assert sum('url_key=key' in call.request.url for call in responses.calls) == 1
+
+        migrated = list(migrate_links(api, target, ['a', 'b/key'], workers=2))
+        assert [(ending, shortened.value) for ending, _, shortened in migrated] == [('a', short_url), ('b', short_url)]
+        shorten_urls = [call.request.url for call in responses.calls if call.request.url.startswith('https://ta.rget')]
+        assert any('custom_ending=a' in url and 'is_secret=false' in url for url in shorten_urls)
+        assert any('custom_ending=b' in url and 'is_secret=true' in url for url in shorten_urls)
+
+        calls = len(responses.calls)
+        assert all(shortened is None for _, _, shortened in migrate_links(api, target, ['a'], dry_run=True))
+        assert len(responses.calls) == calls + 1
+
+    @responses.activate
+    def test_cli(self, tmpdir):
+        from mypolr import is_cli_supported
+
+        if not is_cli_supported:
+            return
+
+        import io
+        from mypolr.cli import MypolrCli, get_args, make_pooled_session
+
+        session = make_pooled_session(16)
+        assert session.get_adapter('https://ti.ny')._pool_maxsize == 16
+        assert session.get_adapter('http://ti.ny') is session.get_adapter('https://ti.ny')
+
+        args = get_args(['migrate', 'endings.txt', '--target-server', 'https://ta.rget', '--target-key', 'k'])
+        assert (args.command, args.endings, args.workers, args.dry_run) == ('migrate', 'endings.txt', 8, False)
+        assert get_args([]).command is None
+
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        endings = tmpdir.join('endings.txt')
+        endings.write('a\nb\n')
+        output = io.StringIO()
+        MypolrCli(output, ['export', str(endings), '-s', api_server, '-k', api_key]).run()
+        assert output.getvalue() == 'a\t{}\n'.format(long_url)
+
+
+class TestLookupCache:
+    def test_cache(self):
+        from mypolr.cache import LookupCache
+
+        now = [1000.0]
+        cache = LookupCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', False)
+        assert cache.get('b') is False and cache.get('a') == 1
+        cache.set('c', 3)  # evicts 'b', since 'a' was used more recently
+        assert cache.get('b') is None and len(cache) == 2
+        assert cache.expires('a') == 1010.0
+        now[0] = 1010.0
+        assert cache.get('a', 'expired') == 'expired'
+        cache.clear()
+        assert len(cache) == 0
+
+    @responses.activate
+    def test_cached_lookup(self):
+        from mypolr.cache import LookupCache
+
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        cached_api = PolrApi(api_server, api_key, lookup_cache=LookupCache())
+        for _ in range(2):
+            assert cached_api.lookup('abcd') == lookup_resp['result']
+            assert cached_api.lookup(api_server + '/missing') is False
+        assert len(responses.calls) == 2
+
+    @responses.activate
+    def test_prefetch(self):
+        import io
+
+        from mypolr.cache import LookupCache
+
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        with pytest.raises(ValueError):
+            PolrApi(api_server, api_key).prefetch(['a'])
+        prefetch_api = PolrApi(api_server, api_key, lookup_cache=LookupCache())
+        prefetcher = prefetch_api.prefetch(io.StringIO(u'a\n\nb/key\n'), rate=None, check_interval=0.01)
+        assert prefetcher.warmed.wait(5)
+        assert len(responses.calls) == 2
+        assert prefetch_api.lookup('a') == prefetch_api.lookup('b', 'key') == lookup_resp['result']
+        assert len(responses.calls) == 2
+
+        # All entries are refreshed in the background when they are about to expire
+        import time
+        prefetcher.refresh_ahead = prefetch_api.lookup_cache.ttl
+        deadline = time.time() + 5
+        while len(responses.calls) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        prefetcher.stop(5)
+        assert len(responses.calls) >= 4
+
+
+class TestConfig:
+    ini = '[connection]\napi_server = https://ti.ny\napi_key = default_key\n\n' \
+          '[work]\napi_server = https://wo.rk\napi_key = work_key\napi_root = /api/v3/\n'
+
+    def test_load_config(self, tmpdir):
+        from mypolr import config
+
+        path = tmpdir.join('config.ini')
+        path.write(self.ini)
+        path = str(path)
+        assert config.load_config(path=path, environ={}) == dict(api_server='https://ti.ny', api_key='default_key',
+                                                                 api_root=None)
+        assert config.load_config('work', path, environ={})['api_root'] == '/api/v3/'
+        assert config.load_config(path=path, environ={'MYPOLR_PROFILE': 'work'})['api_key'] == 'work_key'
+        # Server and key come from the environment only as a pair
+        assert config.load_config(path=path, environ={'MYPOLR_KEY': 'env_key'})['api_key'] == 'default_key'
+        assert config.load_config(path=path, environ={'MYPOLR_API_ROOT': '/v2/'})['api_root'] == '/v2/'
+        assert config.load_config('missing', path, environ={})['api_server'] is None
+
+        # The file is parsed only once, and not read when environment variables give both server and key
+        tmpdir.join('config.ini').write('')
+        assert config.load_config(path=path, environ={})['api_key'] == 'default_key'
+        config.forget_config_file(path)
+        assert config.load_config(path=path, environ={})['api_key'] is None
+        environ = dict(MYPOLR_SERVER='https://e.nv', MYPOLR_KEY='k')
+        values = config.load_config(path=str(tmpdir.join('not_read.ini')), environ=environ)
+        assert (values['api_server'], values['api_key']) == ('https://e.nv', 'k')
+        assert str(tmpdir.join('not_read.ini')) not in config._parsed_files
+
+    def test_from_config(self, tmpdir, monkeypatch):
+        path = tmpdir.join('config.ini')
+        path.write(self.ini)
+        for name in ('MYPOLR_SERVER', 'MYPOLR_KEY', 'MYPOLR_API_ROOT', 'MYPOLR_PROFILE'):
+            monkeypatch.delenv(name, raising=False)
+
+        work_api = PolrApi.from_config('work', str(path))
+        assert (work_api.api_base, work_api.api_key) == ('https://wo.rk/api/v3/', 'work_key')
+        assert PolrApi.from_config(path=str(path)).api_base == 'https://ti.ny' + DEFAULT_API_ROOT
+        with pytest.raises(polr_errors.ConfigurationError):
+            PolrApi.from_config('missing', str(path))
+
+        monkeypatch.setenv('MYPOLR_SERVER', 'https://e.nv')
+        work_api = PolrApi.from_config('work', str(path))
+        assert (work_api.api_server, work_api.api_key) == ('https://wo.rk', 'work_key')
+        monkeypatch.setenv('MYPOLR_KEY', 'env_key')
+        env_api = PolrApi.from_config('work', str(path))
+        assert (env_api.api_server, env_api.api_key) == ('https://e.nv', 'env_key')
+
+    def test_cli_profiles(self, tmpdir, monkeypatch):
+        from mypolr import is_cli_supported
+
+        if not is_cli_supported:
+            return
+
+        import io
+        from mypolr.cli import MypolrCli
+
+        monkeypatch.setenv('HOME', str(tmpdir))
+        for name in ('MYPOLR_SERVER', 'MYPOLR_KEY', 'MYPOLR_API_ROOT', 'MYPOLR_PROFILE'):
+            monkeypatch.delenv(name, raising=False)
+        output = io.StringIO()
+        MypolrCli(output, ['--save', '-s', 'https://ti.ny', '-k', 'default_key']).run()
+        MypolrCli(output, ['--save', '-s', 'https://wo.rk', '-k', 'work_key', '-p', 'work']).run()
+
+        cli = MypolrCli(output, ['-p', 'work'])
+        cli.load_configs_from_ini()
+        assert (cli.api_server, cli.api_key) == ('https://wo.rk', 'work_key')
+        cli = MypolrCli(output, [])
+        cli.load_configs_from_ini()
+        assert (cli.api_server, cli.api_key) == ('https://ti.ny', 'default_key')
+        assert cli.make_ini_getter()('api_key') == 'default_key'
+
+
+class TestClientRegistry:
+    def test_registry(self):
+        from mypolr.registry import ClientRegistry
+
+        now = [0.0]
+        registry = ClientRegistry(idle_timeout=10, clock=lambda: now[0])
+        first = registry.get('https://ti.ny/', 'key_a', 'api/v2')
+        assert registry.get('https://ti.ny', 'key_a') is first
+        other_key = registry.get('https://ti.ny', 'key_b')
+        other_host = registry.get('https://other.host', 'key_a')
+        assert other_key is not first and len(registry) == 3
+        assert other_key.session is first.session
+        assert other_host.session is not first.session
+
+        now[0] = 6.0
+        registry.get('https://ti.ny', 'key_a')
+        now[0] = 12.0
+        registry.evict_idle()
+        assert len(registry) == 1
+        assert list(registry._sessions) == [('https', 'ti.ny')]
+        registry.close()
+        assert len(registry) == 0
+
+    def test_separate_caches(self):
+        from mypolr.cache import LookupCache
+        from mypolr.loadtest import StubPolrServer
+        from mypolr.registry import ClientRegistry
+
+        registry = ClientRegistry(api_kwargs_factory=lambda key: dict(lookup_cache=LookupCache()))
+        with StubPolrServer() as server_a, StubPolrServer() as server_b:
+            server_a.shorten('https://tenant-a.example', 'same')
+            server_b.shorten('https://tenant-b.example', 'same')
+            tenant_a = registry.get(server_a.url, server_a.api_key)
+            tenant_b = registry.get(server_b.url, server_b.api_key)
+            assert tenant_a.lookup_cache is not tenant_b.lookup_cache
+            assert tenant_a.lookup('same')['long_url'] == 'https://tenant-a.example'
+            assert tenant_b.lookup('same')['long_url'] == 'https://tenant-b.example'
+            registry.close()
+
+    @responses.activate
+    def test_shared_client(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from mypolr.registry import get_client
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        with ThreadPoolExecutor(4) as executor:
+            clients = list(executor.map(lambda _: get_client(api_server, api_key), range(8)))
+            assert len(set(map(id, clients))) == 1
+            assert list(executor.map(lambda client: client.shorten(long_url), clients)) == [short_url] * 8
+
+
+class TestPreparedRequests:
+    @responses.activate
+    def test_prepared_urls(self):
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        session_api = PolrApi(api_server, api_key, session=requests.Session())
+        for polr_api in (api, session_api):
+            polr_api.shorten(u'https://example.com/?a=1&b=\u00e6 \u00f8', custom_ending='c/d', is_secret=True)
+            polr_api.lookup('abcd', url_key='k&y')
+            polr_api.lookup('abcd')
+
+        expected = [
+            (api.api_shorten_endpoint,
+             dict(url=u'https://example.com/?a=1&b=\u00e6 \u00f8', is_secret='true', custom_ending='c/d')),
+            (api.api_lookup_endpoint, dict(url_ending='abcd', url_key='k&y')),
+            (api.api_lookup_endpoint, dict(url_ending='abcd')),
+        ]
+        for call, (endpoint, params) in zip(responses.calls, expected * 2):
+            params.update(api._base_params)
+            expected_url = requests.Request('GET', endpoint, params=params).prepare().url
+            # Same encoding of each parameter, but parameter order may differ
+            for url in (call.request.url, expected_url):
+                assert url.startswith(endpoint + '?')
+            assert sorted(call.request.url.split('?')[1].split('&')) == sorted(expected_url.split('?')[1].split('&'))
+
+
+class TestProgressReporter:
+    def test_reports(self):
+        import io
+        from mypolr.progress import ProgressReporter
+
+        now = [100.0]
+        snapshots = []
+        stream = io.StringIO()
+        progress = ProgressReporter(total=10, stream=stream, callback=snapshots.append, interval=2,
+                                    clock=lambda: now[0])
+        for _ in range(3):
+            now[0] += 0.5
+            progress.record()
+        assert snapshots == []  # Less than one interval has passed
+        now[0] += 0.5
+        progress.record('QuotaExceededError')
+        progress.add(1)  # Not reported, as the next report is due after two more seconds
+        assert len(snapshots) == 1
+        assert snapshots[0] == dict(done=4, total=10, elapsed=2.0, rate=2.0, errors={'QuotaExceededError': 1},
+                                    error_rate=0.25, eta=3.0, concurrency=1)
+        assert stream.getvalue() == ('4/10 (40%) done, 2.0/s, 25.0% errors (QuotaExceededError: 1), '
+                                     'ETA 3s, concurrency 1\n')
+        progress.close()
+        assert snapshots[-1]['done'] == 5 and len(stream.getvalue().splitlines()) == 2
+        assert ProgressReporter.format(dict(snapshots[0], total=None, eta=None)).startswith('4 done, ')
+
+    @responses.activate
+    def test_bulk_operations(self, tmpdir):
+        from mypolr.bulk import BulkRunner
+        from mypolr.migrate import export_links
+        from mypolr.progress import ProgressReporter
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        progress = ProgressReporter(stream=None)
+        api.shorten_many([long_url, long_url, 'https://other.example.com'], progress=progress)
+        assert (progress.done, progress.total, progress.errors) == (2, 2, {'QuotaExceededError': 1})
+
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        progress = ProgressReporter(stream=None)
+        list(export_links(api, ['a', 'b'], workers=3, progress=progress))
+        assert (progress.done, progress.errors, progress.concurrency) == (2, {'NotFound': 2}, 3)
+
+        responses.reset()
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        input_path = tmpdir.join('urls.txt')
+        input_path.write('{0}\n{0}\nhttps://other.example.com\n'.format(long_url))
+        progress = ProgressReporter(stream=None)
+        BulkRunner(api, processes=1, shards_per_process=1, progress=progress).run(
+            str(input_path), str(tmpdir.join('out.tsv')))
+        assert (progress.done, progress.errors) == (3, {'QuotaExceededError': 1})
+
+
+class TestApiEngine:
+    @responses.activate
+    def test_sync_and_futures(self):
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json={}, status=404)
+        plain_api = PolrApi(api_server, api_key)
+        with plain_api.make_engine(workers=2, rate=100) as engine:
+            assert engine.api is not plain_api and engine.api.session is not None
+            assert engine.api.lookup_cache is not None
+            assert plain_api.session is None and plain_api.lookup_cache is None
+            assert engine.shorten(long_url) == short_url
+            assert engine.submit_lookup('a').result().value == lookup_resp['result']
+            assert engine.lookup('b') is False
+            # Cached results are returned without taking a slot of the rate limit
+            next_slot = engine.limiter._next_slot.value
+            assert engine.lookup('a') == lookup_resp['result']
+            assert engine.submit_lookup(api_server + '/b').result().value is False
+            assert engine.limiter._next_slot.value == next_slot
+        assert len(responses.calls) == 3
+
+        responses.add('GET', api.api_shorten_endpoint, json={}, status=403)
+        with plain_api.make_engine() as engine:
+            with pytest.raises(polr_errors.QuotaExceededError):
+                engine.shorten(long_url)
+
+    @responses.activate
+    def test_asyncio(self):
+        asyncio = pytest.importorskip('asyncio')
+
+        responses.add('GET', api.api_shorten_endpoint, json=shorten_resp, status=200)
+        responses.add('GET', api.api_lookup_endpoint, json=lookup_resp, status=200)
+        from mypolr.cache import LookupCache
+
+        session_api = PolrApi(api_server, api_key, session=requests.Session(), lookup_cache=LookupCache())
+        loop = asyncio.new_event_loop()
+        try:
+            with session_api.make_engine(workers=4) as engine:
+                assert engine.api is session_api
+                shortened, looked_up = loop.run_until_complete(asyncio.gather(
+                    engine.shorten_async(long_url, loop=loop), engine.lookup_async('a', loop=loop)))
+        finally:
+            loop.close()
+        assert (shortened.value, looked_up.value) == (short_url, lookup_resp['result'])
+
+
+class TestLoadTest:
+    def test_percentile(self):
+        from mypolr.loadtest import percentile
+
+        values = list(range(1, 101))
+        assert [percentile(values, p) for p in (0, 50, 90, 99, 100)] == [1, 50, 90, 99, 100]
+        assert percentile([3.0], 99) == 3.0 and percentile([], 50) is None
+
+    def test_stub_server(self):
+        from mypolr.loadtest import LoadTest, StubPolrServer
+
+        with StubPolrServer(api_key=api_key) as stub:
+            stub_api = PolrApi(stub.url, api_key, session=requests.Session())
+            assert stub_api.shorten(long_url, custom_ending='x') == stub.url + '/x'
+            with pytest.raises(polr_errors.CustomEndingUnavailable):
+                stub_api.shorten(long_url, custom_ending='x')
+            assert stub_api.lookup('x') == dict(long_url=long_url, clicks=0)
+            assert stub_api.lookup('missing') is False
+            with pytest.raises(polr_errors.UnauthorizedKeyError):
+                PolrApi(stub.url, 'wrong_key').shorten(long_url)
+
+            corpus = ['https://example.com/{}'.format(i) for i in range(5)]
+            report = LoadTest(stub_api, corpus, lookup_ratio=0.5, concurrency=4, seed=1).run(requests=100)
+        assert report['requests'] == 100 and report['errors'] == {}
+        assert report['operations']['shorten']['count'] + report['operations']['lookup']['count'] == 100
+        assert report['operations']['lookup']['count'] > 0
+        assert 0 < report['latency']['p50'] <= report['latency']['p99'] <= report['latency']['max']
+        assert set(stub.links.values()) == set(corpus + [long_url])
+
+    def test_errors_and_cli(self):
+        from mypolr import is_cli_supported
+        from mypolr.loadtest import LoadTest, StubPolrServer
+
+        with StubPolrServer(error_rate=1.0) as stub:
+            report = LoadTest(PolrApi(stub.url, stub.api_key), concurrency=2).run(requests=10)
+        assert report['errors'] == {'ServerOrConnectionError': 10}
+        assert report['operations']['lookup']['count'] == 0
+
+        if not is_cli_supported:
+            return
+
+        import io
+        from mypolr.cli import MypolrCli
+
+        output = io.StringIO()
+        MypolrCli(output, ['loadtest', '--stub', '-n', '50', '--progress-interval', '0']).run()
+        lines = output.getvalue().splitlines()
+        assert lines[0].startswith('50 requests in ') and lines[-1] == 'errors         0 (0.0%)'